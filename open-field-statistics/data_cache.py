@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import tempfile
+import inspect
+import numpy as np
+import pandas as pd
+
+from settings import STAGE_PARAMETERS
+from data_processing import DATA_COLUMNS
+
+
+CACHE_DIR = os.path.join('temp', 'cache')
+CACHE_SIZE = 1024**3  # Least recently used files are deleted above this size
+# Change when preprocessing changes to invalidate old cache files
+CACHE_VERSION = 6
+
+
+class DataCache():
+    def __init__(self, window):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Preprocessed data saved to disk, so that a raw data file is parsed
+        and preprocessed only once for each configuration of preprocessing
+        '''
+
+        self.window = window
+        self.params = window.settings.params
+
+        # Hashes of already hashed files: {(path, size, mtime): hash}
+        self.file_hashes = {}
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+    def hash_file(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Hash of the file content, reused while the file is not modified '''
+
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+        if file_id not in self.file_hashes:
+            file_hash = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as file:
+                while block := file.read(1024**2):
+                    file_hash.update(block)
+            self.file_hashes[file_id] = file_hash.hexdigest()
+
+        return self.file_hashes[file_id]
+
+    def cache_file(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Cache file name from the content of data file and settings
+        of preprocessing. Run-length encoded data are made while reading
+        large files and cached apart from every sample
+        '''
+
+        params = json.dumps([CACHE_VERSION]
+                            + [self.params[param]
+                               for param in (STAGE_PARAMETERS['preprocessing']
+                                             + STAGE_PARAMETERS['runs'])])
+        key = hashlib.blake2b(
+            (self.hash_file(path) + params).encode(),
+            digest_size=16).hexdigest()
+
+        return os.path.join(CACHE_DIR, f'{key}.npz')
+
+    def load(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Return preprocessed data of the file, None if not cached '''
+
+        cache_file = self.cache_file(path)
+        if not os.path.exists(cache_file):
+            return None
+
+        try:
+            with np.load(cache_file) as arrays:
+                # Native rate data also have duration of each sample
+                columns = [column for column in [*DATA_COLUMNS, 'duration']
+                           if column in arrays]
+                df = pd.DataFrame(
+                    {column: arrays[column] for column in columns},
+                    index=pd.to_timedelta(arrays['time']).rename('time')
+                    )
+                start = int(arrays['start'])
+                interval = int(arrays['interval'])
+        # Broken file, e.g. the app was closed while saving it
+        except (OSError, ValueError, KeyError):
+            try:
+                os.remove(cache_file)
+            except FileNotFoundError:
+                pass
+            return None
+
+        # Mark as recently used, unless it was just evicted
+        try:
+            os.utime(cache_file)
+        except FileNotFoundError:
+            pass
+
+        df = df.rename_axis(columns='stats')
+        df.attrs['start'] = start
+        df.attrs['interval'] = interval
+
+        return df
+
+    def save(self, path, df):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Save preprocessed data of the file, evict least recently used '''
+
+        cache_file = self.cache_file(path)
+
+        # Write to a temporary file first, not to leave a broken cache file.
+        # Its name is unique, a cancelled loading may still be saving the same file
+        handle, temp_file = tempfile.mkstemp(suffix='.tmp', dir=CACHE_DIR)
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                np.savez(file,
+                         time=df.index.to_numpy().view(np.int64),
+                         start=df.attrs['start'],
+                         interval=df.attrs['interval'],
+                         **{column: df[column].to_numpy()
+                            for column in [*DATA_COLUMNS, 'duration']
+                            if column in df})
+            os.replace(temp_file, cache_file)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Delete least recently used cache files above CACHE_SIZE '''
+
+        # Another loading may be evicting the same files at the same time
+        cache_files = []
+        for entry in os.scandir(CACHE_DIR):
+            if entry.name.endswith('.npz'):
+                try:
+                    cache_files.append((entry.stat().st_mtime_ns,
+                                        entry.stat().st_size, entry.path))
+                except FileNotFoundError:
+                    pass
+        cache_files.sort(reverse=True)
+
+        size = 0
+        for i, (_mtime, file_size, cache_file) in enumerate(cache_files):
+            size += file_size
+            # Always keep the most recent one
+            if size > CACHE_SIZE and i:
+                try:
+                    os.remove(cache_file)
+                except FileNotFoundError:
+                    pass
@@ -1,6 +1,43 @@
 import numpy as np
 import pandas as pd
 import inspect
+import collections
+
+import kernels
+from data_reader import DAY_NS
+
+
+# Preprocessed columns used by map and statistics, in compact types
+DATA_COLUMNS = {'z': bool,
+                'x': np.float32, 'x_amb': np.float32,
+                'y': np.float32, 'y_amb': np.float32,
+                'dist_total': np.float32, 'dist_amb': np.float32,
+                'dz': bool,
+                'cell': np.int32}
+# Raw data with a missing beam coordinate in every row
+NO_SAMPLES_ERROR = 'No rows with all four beam coordinates'
+RESULTS_CACHE_SIZE = 64  # Output tables kept for revisited configurations
+# Statistics of each map cell shown as heatmaps: occupancy time,
+# ambulatory distance and rearing starts. Their cumulative sums are
+# stored every HEATMAP_STRIDE rows
+HEATMAP_STATS = ['time', 'distance', 'rearings']
+HEATMAP_STRIDE = 4096
+# Statistics summed over time by zone: time (ns), distances,
+# rearing starts (dz) and rearing time (ns). Their cumulative sums
+# are stored every PREFIX_STRIDE rows
+PREFIX_STATS = ['time', 'dist_total', 'dist_amb', 'rearing_n', 'rearing_time']
+PREFIX_STRIDE = 256
+# Statistics computed in beams, scaled to cm only in the output table,
+# so that field size changes do not need preprocessing again
+SCALED_STATS = ['dist_total', 'dist_amb', 'velocity']
+# Statistics of peri-event windows, each window is aggregated from
+# cumulative sums at its two ends
+EVENT_STATS = ['time', 'dist_total', 'dist_amb', 'velocity',
+               'rearing_n', 'rearing_time']
+
+
+def no_progress(stage, fraction=None):
+    ''' Default progress callback, progress is not reported '''
 
 
 class DataProcessing():
@@ -14,6 +51,34 @@ class DataProcessing():
 
         self.has_file = False
         self.zones = np.array([])  # List of existing zone numbers
+
+        # Samples of each row, zone of each row, changes of zone,
+        # cumulative sums of statistics, built for these data and zones
+        # (hash of zoneCoord). Live data are only extended by new rows
+        self.samples_df = None
+        self.zone_lookup_df = None
+        self.zone_lookup_key = None
+        self.changes_df = None
+        self.changes_key = None
+        self.bouts_df = None
+        self.bouts_key = None
+        self.prefix_df = None
+        self.prefix_zone_key = None
+        self.heatmap_df = None
+        # Data of each followed recording grow in place (GrowingArray)
+        self.live = 0
+        self.live_columns = None
+        # Zones of the previous get_data call
+        self.last_zone_key = None
+
+        # Output tables of recent configurations, least recently used first
+        self.results = collections.OrderedDict()
+        self.results_df = None
+
+        # Imported events (time, label) and their statistics
+        # of each recording, to be averaged across recordings
+        self.events = None
+        self.event_results = {}
         self.dummy_data = self.make_dummy_data()
 
     def make_dummy_data(self):
@@ -47,32 +112,40 @@ class DataProcessing():
 
         return max_x, max_y
 
-    def process_raw_data(self, df):
+    def process_raw_data(self, df, progress=no_progress):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
-        ''' Preprocess raw data independent of time and zone parameters '''
-
-        def filter_ambulatory(df, ax):
-            df[f'{ax}_diff'] = df[f'{ax}'].diff()
-            df = df.loc[df.loc[:, f'{ax}_diff'] != 0, [f'{ax}', f'{ax}_diff']]
-            df[f'{ax}_rolling'] = (df[f'{ax}_diff']
-                                   .rolling(window=2, min_periods=1).sum())
-            df[f'{ax}_amb'] = (df[f'{ax}']
-                               .loc[df[f'{ax}_rolling'] != 0]
-                               .ffill())
+        '''
+        Preprocess raw data independent of time and zone parameters.
+        progress(stage, fraction) is called before each stage
+        '''
 
-            return df[[f'{ax}_amb']]
+        # Native rate: samples are not resampled, but weighted by duration
+        if not self.params['sampleInterval']:
+            progress('Preprocessing', 0.4)
+            stream = self.make_stream()
+            df = [stream.process_chunk(df), stream.finish()]
+            if stream.start is None:
+                raise ValueError(NO_SAMPLES_ERROR)
+            df = pd.concat(df)
+            df = df.rename_axis(columns='stats')
+            df.attrs.update(start=stream.start, interval=0)
+            return df
 
         # Exclude rows with any of four coordinates missing
 #TODO mention this behavior in documentation
         df = df.loc[(df.loc[:, 'x1':'y2'] != 0).all(axis=1)]
+        if df.empty:
+            raise ValueError(NO_SAMPLES_ERROR)
 
         # Absolute timestamps to timedeltas since start
-        df.index -= df.index[0]
+        start = df.index[0]
+        df.index -= start
 
-        # Resample to 0.1 s
+        # Resample to the sample interval
+        progress('Resampling', 0.4)
         df = (df
-              .resample('100ms', origin='start')
+              .resample(f"{self.params['sampleInterval']}ms", origin='start')
               .agg({'x1': 'mean', 'x2': 'mean',
                     'y1': 'mean', 'y2': 'mean',
                     'z': 'any'})
@@ -83,9 +156,13 @@ class DataProcessing():
         df['y1'] = self.params['numLasersY'] - df['y1'] + 1
         df['y2'] = self.params['numLasersY'] - df['y2'] + 1
 
-        for ax in ['x1', 'x2', 'y1', 'y2']:
-            df = df.join(filter_ambulatory(df[[ax]].copy(), ax), how='outer')
-            df[f'{ax}_amb'] = df[f'{ax}_amb'].ffill()
+        progress('Ambulatory filter', 0.6)
+        # All four beam axes at once
+        beams = ['x1', 'x2', 'y1', 'y2']
+        amb, _state = filter_ambulatory(
+            df[beams].to_numpy(dtype=np.float64),
+            backend=kernels.select_backend(self.params['kernelBackend']))
+        df[[f'{ax}_amb' for ax in beams]] = amb
 
         for xy in ['x', 'y']:
             for amb in ['', '_amb']:
@@ -96,13 +173,9 @@ class DataProcessing():
                 # Change to Euclidean coordinates
                 df[f'{xy}{amb}'] -= 0.5
 
-                # Distance by each axis
+                # Distance by each axis, in beams
                 df[f'd{xy}{amb}'] = df[f'{xy}{amb}'].diff()
 
-                # Convert to real world distance in cm
-                df[f'd{xy}{amb}'] *= (self.params['boxSideX']
-                                      / self.params['numLasersX'])
-
         # Distance travelled since previous timestamp
         df['dist_total'] = np.hypot(df['dx'], df['dy'])
         df['dist_amb'] = np.hypot(df['dx_amb'], df['dy_amb'])
@@ -111,56 +184,860 @@ class DataProcessing():
         df['dz'] = df['z'].diff()
         df['dz'] = df[['z', 'dz']].all(axis=1)
 
+        df['cell'] = cell_index(df['x_amb'].to_numpy(), df['y_amb'].to_numpy(),
+                                self.params['numLasersX'])
+
+        # Drop intermediate columns
+        df = df[list(DATA_COLUMNS)].astype(DATA_COLUMNS)
+
         df = df.rename_axis(columns='stats')
+        # Time since midnight when the recording started, to join split parts
+        df.attrs['start'] = start.value
+        df.attrs['interval'] = self.params['sampleInterval'] * 10**6
 
-        self.df = df
+        return df
 
-    def pivot_zone_wise(self, df, index):
+    def process_raw_data_chunked(self, chunks, progress=no_progress):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
-        df = (df
-              .rename(columns={'x': 'time', 'dz': 'rearing_n', 'z': 'rearing_time'})
-              .pivot_table(
-                  index=index,
-                  columns='zone',
-                  values=['time', 'dist_total', 'dist_amb',
-                          'rearing_n', 'rearing_time'],
-                  aggfunc={'time': 'count',
-                           'dist_total': 'sum',
-                           'dist_amb': 'sum',
-                           'rearing_n': 'sum',
-                           'rearing_time': 'sum'}
-              )
-              )
+        '''
+        Preprocess raw data read in chunks, without holding the whole file
+        or the intermediate columns in memory.
+        Return preprocessed data and max X and Y (as checkDataToField),
+        data are None if they do not fit the field
+        '''
+
+        stream = self.make_stream()
+        processed = []
+        # Last run of a chunk can continue in the next one
+        held = None
+        for chunk in chunks:
+            max_x, max_y = self.checkDataToField(chunk)
+            if max_x or max_y:
+                return None, (max_x, max_y)
+            progress('Parsing and preprocessing')
+            samples = stream.process_chunk(chunk)
+            if self.params['trajectoryRLE']:
+                samples, held = self.chunk_runs(held, samples, stream.interval)
+            processed.append(samples)
+        samples = stream.finish()
+        if self.params['trajectoryRLE']:
+            samples, held = self.chunk_runs(held, samples, stream.interval)
+            processed += [samples, held]
+        else:
+            processed.append(samples)
+        if stream.start is None:
+            raise ValueError(NO_SAMPLES_ERROR)
+
+        df = pd.concat(processed).rename_axis(columns='stats')
+        df.attrs.update(start=stream.start, interval=stream.interval)
+
+        return df, (0, 0)
+
+    def chunk_runs(self, held, df, interval):
+        '''
+        Runs of preprocessed samples of a chunk (to_runs) following the
+        held last run of the previous chunk. Return complete runs and the
+        last run, held until the next chunk
+        '''
+
+        if df is None or not len(df):
+            return None, held
+
+        if 'duration' not in df:
+            df = df.assign(duration=np.int64(interval))
+        if held is not None:
+            df = pd.concat([held, df])
+        df.attrs['interval'] = interval
 
-        # Account for occasional one 0.1 s line leftover
-        if ('time' in df.columns
-                and df.loc[df.index[-1], 'time'].sum() == 1):
-            df = df.drop(index=df.index[-1])
+        runs = encode_runs(df)
+
+        return runs.iloc[:-1], runs.iloc[-1:]
+
+    def make_stream(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Incremental preprocessing at the sample interval of settings '''
+
+        if self.params['sampleInterval']:
+            return ChunkedProcessing(self.params)
+        return NativeProcessing(self.params)
+
+    def join_parts(self, parts):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        One recording from preprocessed parts of a session split into several
+        files by acquisition software, in order. Each part is shifted to the
+        time its recording started (continuing over midnight), rounded to
+        the sample interval. Distance is not counted across the gap
+        between parts
+        '''
+
+        if len(parts) == 1:
+            return parts[0]
+
+        first = parts[0].attrs['start']
+        interval = parts[0].attrs['interval']
+        end = 0
+        shifted = []
+        for df in parts:
+            offset = df.attrs['start'] - first
+            # Part started after midnight
+            while offset < end - DAY_NS // 2:
+                offset += DAY_NS
+            # Samples of the parts do not overlap
+            if interval:
+                offset = round(offset / interval) * interval
+            offset = max(offset, end)
+
+            shifted.append(df.set_axis(df.index + pd.Timedelta(offset)))
+            # Runs in loading thread, positions cached for statistics
+            # computed in background are not touched
+            (_time, duration, _before, _step), _ = sample_positions(df)
+            end = offset + df.index[-1].value + int(duration[-1])
+
+        df = pd.concat(shifted).rename_axis(columns='stats')
+        df.attrs.update(start=first, interval=interval)
 
         return df
 
-    def get_data(self):
+    def start_live(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Prepare to preprocess a raw data file while it is being written '''
+
+        self.stream = self.make_stream()
+        self.df = None
+
+        # Data of this recording are told from others by attrs['live']
+        self.live += 1
+        self.live_columns = None
+
+    def append_raw_data(self, df):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
+        '''
+        Preprocess raw data rows appended to the file and add them to data.
+        Return False if they did not complete any sample yet
+        '''
+
+        processed = self.stream.process_chunk(df)
+        if processed is None or not len(processed):
+            return False
+
+        if self.live_columns is None:
+            self.live_columns = {column: GrowingArray(processed[column].dtype)
+                                 for column in processed}
+            self.live_time = GrowingArray(np.int64)
+        for column, values in self.live_columns.items():
+            values.extend(processed[column].to_numpy())
+        self.live_time.extend(processed.index.to_numpy().view(np.int64))
+
+        # Data grow in place, each update is a new frame over the same
+        # arrays. Earlier frames keep their rows, so that statistics
+        # computed in background read them meanwhile
+        self.df = pd.DataFrame(
+            {column: values.array
+             for column, values in self.live_columns.items()},
+            index=pd.TimedeltaIndex(self.live_time.array.view('m8[ns]'),
+                                    name=processed.index.name, copy=False),
+            copy=False)
+        self.df.columns.name = 'stats'
+        self.df.attrs.update(start=self.stream.start,
+                             interval=self.stream.interval,
+                             live=self.live)
+
+        return True
+
+    def grown(self, old, df):
+        '''
+        Whether df are live data grown from old by appended rows,
+        so that what was built for old is extended by the new rows only
+        '''
+
+        return (old is not None and 'live' in df.attrs
+                and old.attrs.get('live') == df.attrs['live']
+                and len(old) <= len(df))
+
+    def to_runs(self, df):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Run-length encoded trajectory (encode_runs) of preprocessed data
+        or of joined parts already encoded
+        '''
+
+        return encode_runs(df)
+
+    def total_time(self, df=None):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Time of the last sample of the recording, s.
+        Native rate recording ends with the time of its last sample
+        '''
+
+        df = self.df if df is None else df
+        last = df.index[-1].value
+        # Last sample of a run
+        if 'duration' in df:
+            last += int(df['duration'].iloc[-1]) - df.attrs['interval']
+
+        return last / 10**9
+
+    def memory_usage(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Memory used by preprocessed data of the recording, bytes '''
+
+        return self.df.memory_usage(index=True).sum()
+
+    def snapshot(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Copy of everything get_data depends on, so that statistics can be
+        computed in background while zones and time are being edited.
+        Preprocessed data are never modified, only replaced
+        '''
+
         # List of existing zones (some could have been fully deselected)
-        self.zones = np.unique(self.zoneCoord)
-        self.zones = self.zones[self.zones > 0]
+        self.zones = zone_numbers(self.zoneCoord)
+
+        return {'df': self.df if self.window.file.hasDataFile else None,
+                'zone_coord': self.zoneCoord.copy(),
+                'zone_key': self.zone_key(self.zoneCoord),
+                'zones': self.zones,
+                'time_params': self.timeParams.copy(),
+                'stat_params': list(self.params['statParams']),
+                # Real world distance of one beam, cm
+                'scale': self.params['boxSideX'] / self.params['numLasersX'],
+                'backend': kernels.select_backend(
+                    self.params['kernelBackend']),
+                'immobility_time': self.params['immobilityTime'],
+                'event_windows': (self.params['eventWindowBefore'],
+                                  self.params['eventWindowAfter']),
+                'events': self.events}
+
+    def zone_key(self, zone_coord):
+        ''' Hash of the zone map, changes whenever any cell changes '''
+
+        return hash(zone_coord.tobytes())
+
+    def timestamp_zones(self, snapshot):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Zone masks of map cells and index of the mask of each timestamp.
+        Statistics are aggregated by masks, each zone is then the sum
+        of masks including it. Looked up from cells of timestamps only
+        when data or zones change
+        '''
+
+        df = snapshot['df']
+        if (self.zone_lookup_df is not df
+                or self.zone_lookup_key != snapshot['zone_key']):
+            start = 0
+            if (self.grown(self.zone_lookup_df, df)
+                    and self.zone_lookup_key == snapshot['zone_key']):
+                start = len(self.zone_lookup_df)
+            else:
+                masks, cell_masks = np.unique(snapshot['zone_coord'],
+                                              return_inverse=True)
+                self.zone_cell_masks = (masks, cell_masks.ravel())
+                self.zone_mask_index = GrowingArray(cell_masks.dtype)
+
+            masks, cell_masks = self.zone_cell_masks
+            self.zone_mask_index.extend(
+                cell_masks[df['cell'].to_numpy()[start:]])
+            self.zone_lookup = (masks, self.zone_mask_index.array)
+            self.zone_lookup_df = df
+            self.zone_lookup_key = snapshot['zone_key']
+
+        return self.zone_lookup
+
+    def zone_changes(self, snapshot):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Run-length pass over the zone mask of each row: positions where
+        the mask changes, index of masks before and after each change.
+        Built only when data or zones change
+        '''
+
+        df = snapshot['df']
+        if (self.changes_df is not df
+                or self.changes_key != snapshot['zone_key']):
+            _masks, mask_index = self.timestamp_zones(snapshot)
+            _time, _duration, before, _step = self.sample_positions(df)
+
+            # Changes at the new rows of live data, after the last old row
+            start = 1
+            if (self.grown(self.changes_df, df)
+                    and self.changes_key == snapshot['zone_key']):
+                start = max(len(self.changes_df), 1)
+            else:
+                self.changes_arrays = [GrowingArray(before.dtype),
+                                       GrowingArray(mask_index.dtype),
+                                       GrowingArray(mask_index.dtype)]
+
+            rows = np.flatnonzero(mask_index[start:]
+                                  != mask_index[start - 1:-1]) + start
+            for changes, values in zip(self.changes_arrays,
+                                       [before[rows], mask_index[rows - 1],
+                                        mask_index[rows]]):
+                changes.extend(values)
+            self.changes = tuple(changes.array
+                                 for changes in self.changes_arrays)
+            self.changes_df = df
+            self.changes_key = snapshot['zone_key']
+
+        return self.changes
+
+    def sample_positions(self, df):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Positions of rows of data (sample_positions), built once for the data '''
+
+        if self.samples_df is not df:
+            before = (self.samples_before_array
+                      if self.grown(self.samples_df, df) else None)
+            self.samples, self.samples_before_array = sample_positions(
+                df, before)
+            self.samples_df = df
+
+        return self.samples
+
+    def samples_before(self, df, time_ns):
+        ''' Recorded time of samples earlier than each of times, ns '''
+
+        return samples_before(self.sample_positions(df), time_ns)
+
+    def sample_time(self, df, position):
+        ''' Timestamp of the sample at position, ns '''
+
+        time, _duration, before, _step = self.sample_positions(df)
+        row = np.searchsorted(before, position, side='right') - 1
+
+        return time[row] + (position - before[row])
+
+    def stat_values(self, df, rows=slice(None)):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Values of PREFIX_STATS of each row (slice), (rows, stats),
+        and values of its first sample only
+        '''
+
+        _time, duration, _before, _step = self.sample_positions(df)
+
+        # Distance of the first timestamp is unknown (NaN) and not counted
+        first = np.stack([np.ones(len(df))[rows],
+                          df['dist_total'].to_numpy()[rows],
+                          df['dist_amb'].to_numpy()[rows],
+                          df['dz'].to_numpy()[rows],
+                          df['z'].to_numpy()[rows]],
+                         axis=1)
+        first = np.nan_to_num(first)
+
+        # Samples count for their duration.
+        # Following samples of a run add only time and rearing time
+        values = first.copy()
+        values[:, 0] = duration[rows]
+        values[:, 4] *= duration[rows]
+
+        return values, first
+
+    def period_edges(self, df, start, end, period):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Positions where each period of [start, end] begins, and the end of
+        the last. Periods start at the first sample within the range
+        '''
+
+        first, last = self.samples_before(df, np.array([start, end + 1]))
+
+        origin, periods = 0, 0
+        if last > first:
+            step = self.sample_positions(df)[3]
+            origin = self.sample_time(df, first)
+            span = self.sample_time(df, last - step) - origin
+            if step == 1:
+                # Native rate: a sample at the end of a period ends its time
+                # rather than starts one more period. Time parameters are
+                # set to 0.1 s
+                span = round(span / 10**8) * 10**8
+                periods = max(-(-span // period), 1)
+            else:
+                periods = span // period + 1
+
+        return np.concatenate([
+            [first],
+            self.samples_before(df, origin + np.arange(1, periods) * period),
+            [last]
+            ]).astype(np.int64)
+
+    def build_prefix_sums(self, snapshot):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Cumulative sums of statistics of the whole field and each zone
+        before every PREFIX_STRIDE-th row, (blocks + 1, stats, whole field
+        + zones), so that any time range is aggregated from its two ends
+        and memory is bounded by the stride. Rebuilt only when data
+        or zones change
+        '''
+
+        df = snapshot['df']
+        if (self.prefix_df is df
+                and self.prefix_zone_key == snapshot['zone_key']):
+            return
+
+        masks, mask_index = self.timestamp_zones(snapshot)
+        start = 0
+        if (self.grown(self.prefix_df, df)
+                and self.prefix_zone_key == snapshot['zone_key']):
+            start = len(self.prefix_df)
+        else:
+            columns = zone_columns(masks, snapshot['zones'])
+            self.prefix_columns = columns
+            self.prefix_arrays = (
+                GrowingArray(np.float64, (len(PREFIX_STATS), columns.shape[1])),
+                GrowingArray(np.float64, (len(PREFIX_STATS),)))
+            self.prefix_arrays[0].extend(
+                np.zeros((1, len(PREFIX_STATS), columns.shape[1])))
+        prefix, prefix_first = self.prefix_arrays
+
+        # Values of each row go to the whole field and to every zone its
+        # mask includes. Rows are summed by block and mask, then each zone
+        # is the sum of masks including it.
+        # First block is zero, so that prefix[i] is the sum of rows
+        # before row i * PREFIX_STRIDE. New rows of live data are added
+        # to the sums before the last block
+        block = start // PREFIX_STRIDE
+        rows = slice(block * PREFIX_STRIDE, None)
+        values, first = self.stat_values(df, rows)
+        blocks = -(-len(values) // PREFIX_STRIDE)
+        key = (np.arange(len(values)) // PREFIX_STRIDE * len(masks)
+               + mask_index[rows])
+        sums = np.stack([np.bincount(key, weights=values[:, stat],
+                                     minlength=blocks * len(masks))
+                         for stat in range(len(PREFIX_STATS))],
+                        axis=1)
+        sums = (sums.reshape(blocks, len(masks), -1).swapaxes(1, 2)
+                @ self.prefix_columns)
+        np.cumsum(sums, axis=0, out=sums)
+        sums += prefix.array[block]
+        prefix.truncate(block + 1)
+        prefix.extend(sums)
+        prefix_first.extend(first[start - block * PREFIX_STRIDE:])
+
+        self.prefix = prefix.array
+        self.prefix_first = prefix_first.array
+        self.prefix_df = df
+        self.prefix_zone_key = snapshot['zone_key']
+
+    def prefix_at(self, snapshot, positions):
+        '''
+        Sums of statistics of samples before each of positions (positions,
+        stats, whole field + zones): the stored sums before it, at most
+        PREFIX_STRIDE rows after them and a part of a run the position
+        falls into
+        '''
+
+        _time, duration, before, _step = self.sample_positions(snapshot['df'])
+        masks, mask_index = self.timestamp_zones(snapshot)
+
+        row = np.searchsorted(before, positions, side='right') - 1
+        block = row // PREFIX_STRIDE
+        sums = self.prefix[block]
+
+        # Rows from the stored sums to the row each position falls into,
+        # including it if the position is inside of it
+        partial = positions - before[np.minimum(row, len(duration) - 1)]
+        partial = np.where(row < len(duration), partial, 0)
+        counts = row - block * PREFIX_STRIDE + (partial > 0)
+        owner = np.repeat(np.arange(len(positions)), counts)
+        rows = (np.arange(counts.sum())
+                - np.repeat(np.cumsum(counts) - counts, counts)
+                + np.repeat(block * PREFIX_STRIDE, counts))
+        if not len(rows):
+            return sums
+
+        # First sample of each row and following ones for its duration,
+        # or until the position
+        time = np.where(rows == row[owner], partial[owner], duration[rows])
+        values = self.prefix_first[rows].copy()
+        values[:, 0] = time
+        values[:, 4] *= time
+
+        # Combined (position, mask) key
+        key = owner * len(masks) + mask_index[rows]
+        rest = np.stack([np.bincount(key, weights=values[:, stat],
+                                     minlength=len(positions) * len(masks))
+                         for stat in range(len(PREFIX_STATS))],
+                        axis=1)
+
+        return sums + (rest.reshape(len(positions), len(masks), -1)
+                       .swapaxes(1, 2) @ self.prefix_columns)
+
+    def sum_zone_wise(self, snapshot, edges):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Statistics of each period and of the time outside them, in the whole
+        field and each zone, from cumulative sums: (periods + outside, stats,
+        whole field + zones)
+        '''
+
+        self.build_prefix_sums(snapshot)
+
+        at_edges = self.prefix_at(snapshot, edges)
+        sums = at_edges[1:] - at_edges[:-1]
+        outside = self.prefix[-1] - (at_edges[-1] - at_edges[0])
+
+        return np.concatenate([sums, outside[np.newaxis]])
+
+    def bincount_zone_wise(self, snapshot, edges):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Statistics of each period and of the time outside them, in the whole
+        field and each zone, in one pass over timestamps: (periods + outside,
+        stats, whole field + zones). Timestamps are summed by zone mask once,
+        then each zone is the sum of masks including it
+        '''
+
+        masks, mask_index = self.timestamp_zones(snapshot)
+        columns = zone_columns(masks, snapshot['zones'])
+        values, _first = self.stat_values(snapshot['df'])
+        # Every row is one sample
+        edges = edges // snapshot['df'].attrs['interval']
+
+        if snapshot['backend'] == 'numba':
+            return kernels.sum_periods(values, mask_index, edges,
+                                       len(masks)) @ columns
+
+        # Period of each timestamp, timestamps outside of the selected time
+        # go after the last period
+        periods = len(edges) - 1
+        period_index = np.full(len(values), periods)
+        period_index[edges[0]:edges[-1]] = np.repeat(np.arange(periods),
+                                                     np.diff(edges))
+
+        # Combined (period, mask) key
+        key = period_index * len(masks) + mask_index
+        sums = np.stack([np.bincount(key, weights=values[:, stat],
+                                     minlength=(periods + 1) * len(masks))
+                         for stat in range(len(PREFIX_STATS))],
+                        axis=1)
+
+        return (sums.reshape(periods + 1, len(masks), -1).swapaxes(1, 2)
+                @ columns)
+
+    def format_data(self, snapshot, sums):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        All statistics from sums (periods + outside, stats, whole field
+        + zones):
+        {stat: (whole and selected time + periods, whole field + zones)},
+        time in seconds, distance in beams
+        '''
+
+        periods, outside = sums[:-1], sums[-1]
+        selected = periods.sum(axis=0)
+        sums = np.concatenate([[selected + outside, selected], periods])
+
+        return self.zone_stats(sums)
+
+    def zone_stats(self, sums):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Statistics from sums (rows, stats, whole field + zones) of any
+        time ranges: {stat: (rows, whole field + zones)}, time in seconds,
+        distance in beams
+        '''
+
+        stats = dict(zip(PREFIX_STATS, sums.swapaxes(0, 1)))
+
+        # Convert time from ns to s
+        stats['time'] = stats['time'] / 10**9
+        stats['rearing_time'] = stats['rearing_time'] / 10**9
+
+#TODO mention this behavior in documentation
+        # Calculate velocity
+        # Velocity is calculated from ambulatory distance
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats['velocity'] = stats['dist_amb'] / stats['time']
+
+        return stats
+
+    def output_ranges(self, df, edges):
+        '''
+        Whole time, selected time and each period of edges as ranges
+        of positions, in the layout of format_data
+        '''
+
+        before = self.sample_positions(df)[2]
+
+        return (np.concatenate([[0, edges[0]], edges[:-1]]),
+                np.concatenate([[before[-1], edges[-1]], edges[1:]]))
+
+    def bouts(self, snapshot):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Positions where rearing and immobility bouts start and end:
+        {kind: (start, end)}. Rearing bouts are runs of rows with rearing,
+        immobility bouts are times between ambulatory movements no shorter
+        than immobility time. Built only when data or the threshold change
+        '''
+
+        df = snapshot['df']
+        if (self.bouts_df is not df
+                or self.bouts_key != snapshot['immobility_time']):
+            _time, duration, before, _step = self.sample_positions(df)
+            threshold = snapshot['immobility_time'] * 10**9
+
+            # Bouts completed before the new rows of live data are kept.
+            # Rearing rises and falls, immobility bouts ended by a movement
+            # and the end of the last movement
+            row = 0
+            if (self.grown(self.bouts_df, df)
+                    and self.bouts_key == snapshot['immobility_time']):
+                row = len(self.bouts_df)
+            else:
+                self.bout_arrays = {kind: (GrowingArray(before.dtype),
+                                           GrowingArray(before.dtype))
+                                    for kind in ['rearing', 'immobility']}
+                self.moved = 0
+
+            # Rearing starts and ends at changes of z
+            z = df['z'].to_numpy(np.int8)
+            change = np.diff(np.concatenate([z[row - 1:row] if row else [0],
+                                             z[row:]]))
+            rises, falls = self.bout_arrays['rearing']
+            rises.extend(before[row + np.flatnonzero(change == 1)])
+            falls.extend(before[row + np.flatnonzero(change == -1)])
+
+            # A sample with ambulatory movement is not immobile, the time
+            # before the first and after the last movement is.
+            # Only the first sample of a run moves, native rate samples
+            # last until the next timestamp
+            moving = row + np.flatnonzero(df['dist_amb'].to_numpy()[row:] > 0)
+            moved = before[moving] + (df.attrs['interval'] or duration[moving])
+            start = np.concatenate([[self.moved], moved[:-1]])
+            end = before[moving]
+            immobile = end - start >= threshold
+            for bouts, values in zip(self.bout_arrays['immobility'],
+                                     [start[immobile], end[immobile]]):
+                bouts.extend(values)
+            if len(moving):
+                self.moved = moved[-1]
+
+            # Rearing and immobility lasting at the end of the data
+            start, end = (array.array
+                          for array in self.bout_arrays['immobility'])
+            if before[-1] - self.moved >= threshold:
+                start = np.append(start, self.moved)
+                end = np.append(end, before[-1])
+            self.bout_positions = {
+                'rearing': (rises.array,
+                            np.append(falls.array, before[-1])
+                            if z[-1] else falls.array),
+                'immobility': (start, end)}
+            self.bouts_df = df
+            self.bouts_key = snapshot['immobility_time']
+
+        return self.bout_positions
+
+    def bout_stats(self, snapshot, edges):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Number, time and latency of rearing and immobility bouts in whole
+        and selected time and each period of edges, in the layout
+        of format_data. Bouts count in the period and the zone they start in
+        '''
+
+        masks, mask_index = self.timestamp_zones(snapshot)
+        _time, _duration, before, _step = self.sample_positions(snapshot['df'])
+        starts, ends = self.output_ranges(snapshot['df'], edges)
+        member = zone_membership(masks, snapshot['zones'])
+
+        stats = {}
+        for kind, (start, end) in self.bouts(snapshot).items():
+            mask = mask_index[np.searchsorted(before, start, side='right') - 1]
+
+            # Number and time of bouts up to each bout, by zone mask,
+            # bouts of a range are the difference at its two ends
+            counts = np.zeros((len(start) + 1, 2, len(masks)))
+            counts[np.arange(1, len(start) + 1), 0, mask] = 1
+            counts[np.arange(1, len(start) + 1), 1, mask] = end - start
+            np.cumsum(counts, axis=0, out=counts)
+            sums = (counts[np.searchsorted(start, ends)]
+                    - counts[np.searchsorted(start, starts)])
+            sums = np.concatenate([sums.sum(axis=2, keepdims=True),
+                                   sums @ member], axis=2)
+
+            # Latency of the first bout in range, the whole range if none
+            latency = np.empty((len(starts), member.shape[1] + 1))
+            for i, in_zone in enumerate([None, *member.T]):
+                zone_start = start if in_zone is None else start[in_zone[mask]]
+                first = np.append(zone_start, np.inf)[
+                    np.searchsorted(zone_start, starts)]
+                latency[:, i] = np.minimum(first, ends) - starts
+
+            stats[f'{kind}_n'] = sums[:, 0]
+            stats[f'{kind}_time'] = sums[:, 1] / 10**9
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats[f'{kind}_duration'] = sums[:, 1] / 10**9 / sums[:, 0]
+            stats[f'{kind}_latency'] = latency / 10**9
+
+        # Number and time of rearing are counted over samples (format_data)
+        del stats['rearing_n'], stats['rearing_time']
+
+        return stats
+
+    def zone_events(self, snapshot, edges, time):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Entries, exits, mean visit duration and transitions between zones
+        in whole and selected time and each period of edges, in the layout
+        of format_data. time is time spent in each of them, s
+        '''
+
+        masks, mask_index = self.timestamp_zones(snapshot)
+        position, source, target = self.zone_changes(snapshot)
+        _time, _duration, before, _step = self.sample_positions(snapshot['df'])
+        starts, ends = self.output_ranges(snapshot['df'], edges)
+        member = zone_membership(masks, snapshot['zones'])
+
+        # Number of changes between each (from, to) pair of masks that
+        # occurs, up to each change. Changes of a range are the difference
+        # at its two ends
+        pairs, key = np.unique(source * len(masks) + target,
+                               return_inverse=True)
+        counts = np.zeros((len(key) + 1, len(pairs)))
+        counts[np.arange(1, len(key) + 1), key] = 1
+        np.cumsum(counts, axis=0, out=counts)
+        changes = (counts[np.searchsorted(position, ends)]
+                   - counts[np.searchsorted(position, starts)])
+
+        # Zones left and entered by each pair. Zones can overlap, so one
+        # change can enter or leave several of them. A transition from
+        # one zone to another leaves the first and enters the second
+        left = member[pairs // len(masks)] & ~member[pairs % len(masks)]
+        entered = member[pairs % len(masks)] & ~member[pairs // len(masks)]
+        entries = changes @ entered
+        transitions = ((changes[:, :, np.newaxis] * left).swapaxes(1, 2)
+                       @ entered)
+
+        # Being in a zone at the start of a range is one more visit,
+        # but not an entry
+        visits = entries.copy()
+        first = np.searchsorted(before, starts, side='right') - 1
+        nonempty = np.flatnonzero(ends > starts)
+        visits[nonempty] += member[mask_index[first[nonempty]]]
+
+        # 'Whole_field' counts all changes of zone, including to and from
+        # cells out of zones
+        all_changes = changes.sum(axis=1, keepdims=True)
+        events = {
+            'entries': np.hstack([all_changes, entries]),
+            'exits': np.hstack([all_changes, changes @ left]),
+            }
+        with np.errstate(divide='ignore', invalid='ignore'):
+            events['visit_duration'] = time / np.hstack([
+                all_changes + (ends > starts)[:, np.newaxis], visits])
+
+        # Rows are zones transitions lead to, columns are zones they lead
+        # from, 'Whole_field' is all transitions to the zone
+        for column, zone in enumerate(snapshot['zones']):
+            events[f'transitions_to_{zone}'] = np.hstack([
+                entries[:, [column]], transitions[:, :, column]])
+
+        return events
+
+    def output_table(self, snapshot, results):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Last stage of output, cheap enough to run on every request:
+        distances to cm, selected statistics in their order, rounding
+        '''
+
+        stats, rows, columns = results
+
+        # Transition matrix is one row for each zone
+        stat_rows = []
+        for stat in snapshot['stat_params']:
+            if stat == 'transitions':
+                stat_rows += [f'transitions_to_{zone}'
+                              for zone in snapshot['zones']]
+            else:
+                stat_rows.append(stat)
+
+        # Reorder for final output: (rows, stats, columns)
+        table = (np.array([stats[stat]
+                           * (snapshot['scale'] if stat in SCALED_STATS else 1)
+                           for stat in stat_rows])
+                 .reshape(-1, len(rows), len(columns))
+                 .swapaxes(0, 1)
+                 .reshape(-1, len(columns)))
+
+        # Round to 1 decimal, fill NA with 0
+        table = table.round(decimals=1)
+        table[np.isnan(table)] = 0
+
+        return pd.DataFrame(
+            table,
+            index=pd.MultiIndex.from_product([rows, stat_rows]),
+            columns=pd.Index(columns, name='zone')
+            )
+
+    def get_data(self, snapshot=None):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Output statistics table. Runs in background on a snapshot
+        taken when the table was requested, or on the current state
+        '''
+
+        if snapshot is None:
+            snapshot = self.snapshot()
+        df = snapshot['df']
 
         # Without loaded file return an empty table
-        if not self.window.file.hasDataFile:
+        if df is None:
             return self.make_dummy_data()
 
-        start = self.timeParams['startSelected']
-        end = self.timeParams['endSelected']
-        period = self.timeParams['period']
+        start = snapshot['time_params']['startSelected']
+        end = snapshot['time_params']['endSelected']
+        period = snapshot['time_params']['period']
+
+        # Configuration was shown before for these data.
+        # Statistics and field size only change the last stage
+        results_key = (snapshot['zone_key'], start, end, period,
+                       snapshot['immobility_time'])
+        if self.results_df is not df:
+            self.results.clear()
+            self.results_df = df
+        if results_key in self.results:
+            self.results.move_to_end(results_key)
+            return self.output_table(snapshot, self.results[results_key])
 
 #TODO mention this behavior in documentation
         # Make periods' index in the format 'period_start—period_end'
         # Periods are relative to the start of Selected_time interval,
         # not the start of Whole_time of recording.
         # End of the last period corresponds to the end of Selected_time
-        whole_time = self.df.index[-1].total_seconds()
+        whole_time = self.total_time(df)
         selected_time = np.round(end - start, 1)
         periods = zip(np.arange(0, selected_time, period),
                       np.append(np.arange(period, selected_time, period),
@@ -169,82 +1046,659 @@ class DataProcessing():
         for left, right in periods:
             periods_index.append(f'{left}—{right}')
 
-        start = pd.to_timedelta(start, unit='s')
-        end = pd.to_timedelta(end, unit='s')
         period = pd.to_timedelta(period, unit='s')
 
-#TODO mention this behavior in documentation
-        # Define zone of each timestamp
-        # Zone is determined according to the ambulatory position
-        self.df['zone'] = self.zoneCoord[self.df['y_amb'].astype(int),
-                                         self.df['x_amb'].astype(int)]
-
-        grouper = pd.Grouper(level='time',
-                             freq=period,
-                             origin='start',
-                             closed='left'
-                             )
-
-        # Aggregate data for each period/zone (within Selected_time)
-        data = (self.df
-                .loc[start:end]
-                .pipe(self.pivot_zone_wise, grouper)
-                .set_axis(periods_index, axis='index')
-                )
+        edges = self.period_edges(df,
+                                  pd.to_timedelta(start, unit='s').value,
+                                  pd.to_timedelta(end, unit='s').value,
+                                  period.value)
 
-        # Aggregate data outside of selected_time
-        data.loc['_not_selected'] = (pd
-                                     .concat([self.df.loc[:start-'0.1s'],
-                                              self.df.loc[end+'0.1s':]])
-                                     .pipe(self.pivot_zone_wise, None)
-                                     .unstack().swaplevel()
-                                     )
-
-        data = (pd
-
-                # Add 'Selected_time', 'Whole_time'
-                .concat([data,
-                         pd.Series(data[data.index != '_not_selected'].sum(),
-                                   name='Selected_time').to_frame().T,
-                         pd.Series(data.sum(),
-                                   name='Whole_time').to_frame().T
-                         ])
-                .stack(level='stats', future_stack=True)
+        # Cumulative sums pay off while zones stay the same for several
+        # time ranges. Right after zones changed, one pass is cheaper.
+        # Runs of run-length encoded trajectory and native rate samples
+        # can span several periods
+        if (self.last_zone_key == snapshot['zone_key']
+                or 'duration' in df):
+            sums = self.sum_zone_wise(snapshot, edges)
+        else:
+            sums = self.bincount_zone_wise(snapshot, edges)
+        self.last_zone_key = snapshot['zone_key']
 
-#TODO mention this behavior in documentation
-                # Add 'Whole_field' (including non-selected area)
-                .assign(Whole_field=lambda data_: data_.sum(axis=1))
-                .unstack().stack(level='zone', future_stack=True)
+        # Account for occasional one sample leftover
+        interval = df.attrs['interval']
+        if interval and len(sums) > 1 and sums[-2, 0, 0] == interval:
+            sums = np.delete(sums, -2, axis=0)
+            edges = edges[:-1]
 
-                # Convert time from 100 ms to 1 s
-                .assign(time=lambda data_: data_.time * 0.1)
-                .assign(rearing_time=lambda data_: data_.rearing_time * 0.1)
-
-#TODO mention this behavior in documentation
-                # Calculate velocity
-                # Velocity is calculated from ambulatory distance
-                .assign(velocity=lambda data_: data_.dist_amb / data_.time)
-                .unstack().stack(level=0, future_stack=True)
-
-                # Reorder and rename index values for final output
-                .reindex(columns=['Whole_field'] + self.zones.tolist(),
-                         index=pd.MultiIndex.from_product([
-                             ['Whole_time', 'Selected_time'] + periods_index,
-                             self.params['statParams']])
-                         )
-
-                # Round to 1 decimal, fill NA with 0
-                .astype(float)
-                .round(decimals=1)
-                .fillna(0)
-                )
+        stats = self.format_data(snapshot, sums)
+        stats.update(self.zone_events(snapshot, edges, stats['time']))
+        stats.update(self.bout_stats(snapshot, edges))
 
+        rows = np.arange(len(periods_index) + 2)
         # Do not show single period which is no less than selected_time
         if abs(selected_time - period.total_seconds()) < 0.5:
-            data = data.loc[['Whole_time', 'Selected_time']]
+            rows = rows[:2]
         # Do not show selected_time if it is no less than whole_time
         if abs(whole_time - selected_time) < 0.5:
-            data = data.drop(index='Selected_time', level=0)
+            rows = rows[rows != 1]
+
+        results = ({stat: values[rows] for stat, values in stats.items()},
+                   [(['Whole_time', 'Selected_time'] + periods_index)[row]
+                    for row in rows],
+                   ['Whole_field'] + snapshot['zones'].tolist())
+
+        self.results[results_key] = results
+        if len(self.results) > RESULTS_CACHE_SIZE:
+            self.results.popitem(last=False)
+
+        return self.output_table(snapshot, results)
+
+    def event_times(self, df, events, windows):
+        '''
+        Times of events since the start of the recording, ns.
+        Clock times of the day are resolved against the span of the recording
+        and windows around events (before, after), ns
+        '''
+
+        time = events['time'].to_numpy()
+        if events.attrs['clock']:
+            # First occurrence of the clock time at or after the start of the
+            # recording, maybe past midnight. If its window before the event
+            # misses the recording, the occurrence of the day before is taken
+            # when its window after the event reaches into the recording
+            before, after = windows
+            end = pd.to_timedelta(self.total_time(df), unit='s').value
+            time = (time - df.attrs['start']) % DAY_NS
+            earlier = time - DAY_NS
+            time = np.where((time - before >= end) & (earlier + after > 0),
+                            earlier, time)
+
+        return time
+
+    def event_data(self, snapshot, events, recording):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Statistics in windows before and after each event, averaged across
+        events of each label, as results of get_data. Kept for the recording
+        to be averaged across recordings. None if no event is in the data.
+        Also the number of events outside of the data
+        '''
+
+        df = snapshot['df']
+        before, after = snapshot['event_windows']
+        labels = events['label'].to_numpy()
+
+        # Windows [event - before, event) and [event, event + after).
+        # Windows are cut at the ends of the recording
+        offsets = pd.to_timedelta([-before, 0, after],
+                                  unit='s').to_numpy().view(np.int64)
+        time = self.event_times(df, events, (-offsets[0], offsets[2]))
+        bounds = time[:, np.newaxis] + offsets
+        positions = self.samples_before(df, bounds.ravel())
+
+        # Each window from its two ends
+        self.build_prefix_sums(snapshot)
+        at = self.prefix_at(snapshot, positions).reshape(
+            len(time), 3, len(PREFIX_STATS), -1)
+        sums = (at[:, 1:] - at[:, :-1]).reshape(
+            -1, len(PREFIX_STATS), at.shape[-1])
+        stats = self.zone_stats(sums)
+
+        # Events outside of the recording are not counted
+        recorded = positions.reshape(len(time), 3)
+        recorded = recorded[:, 2] > recorded[:, 0]
+        dropped = int(np.count_nonzero(~recorded))
+        names = pd.unique(labels[recorded])
+        if not len(names):
+            return None, dropped
+
+        stats = {stat: np.concatenate([
+                    nan_mean(values.reshape(len(time), 2, -1)[
+                        recorded & (labels == name)])
+                    for name in names])
+                 for stat, values in stats.items()}
+
+        rows = []
+        for name in names:
+            rows += [f'{name}: {-before}—0', f'{name}: 0—{after}']
+
+        results = (stats, rows, ['Whole_field'] + snapshot['zones'].tolist())
+        self.event_results[recording] = results
+
+        return results, dropped
+
+    def event_average(self, results):
+        '''
+        Mean of event statistics of all recordings with the same events
+        and zones as results, and number of these recordings
+        '''
+
+        same = [other for other in self.event_results.values()
+                if other[1:] == results[1:]]
+        stats = {stat: nan_mean(np.stack([other[0][stat] for other in same]))
+                 for stat in results[0]}
+
+        return (stats, results[1], results[2]), len(same)
+
+    def get_event_data(self, snapshot, recording):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Peri-event statistics of the recording and their mean across
+        recordings, [(title, table)], in the format of get_data.
+        Table is None if no event is in the data.
+        Runs in background on the snapshot of the saved statistics
+        '''
+
+        if snapshot['events'] is None or snapshot['df'] is None:
+            return []
+
+        results, dropped = self.event_data(snapshot, snapshot['events'],
+                                           recording)
+        title = 'Peri-event statistics, mean across events'
+        if dropped:
+            title += (f' ({dropped} of {len(snapshot["events"])} events'
+                      ' outside of the recording)')
+        # Only the note that all events were outside
+        if results is None:
+            return [(title, None)]
+        average, recordings = self.event_average(results)
+
+        # Only statistics summed over time are defined for windows
+        snapshot['stat_params'] = ([stat for stat in snapshot['stat_params']
+                                    if stat in EVENT_STATS]
+                                   or EVENT_STATS)
+
+        return [(title, self.output_table(snapshot, results)),
+                (f'Peri-event statistics, mean across {recordings} recordings',
+                 self.output_table(snapshot, average))]
+
+    def heat_values(self, df, rows):
+        ''' Values of HEATMAP_STATS of rows (slice) of data, (rows, stats) '''
+
+        duration = self.heatmap_samples[1][rows]
+
+        return np.stack([duration,
+                         np.nan_to_num(df['dist_amb'].to_numpy()[rows]),
+                         df['dz'].to_numpy()[rows]],
+                        axis=1)
+
+    def build_heatmaps(self, df):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Cumulative HEATMAP_STATS of each map cell before every
+        HEATMAP_STRIDE-th row, (blocks + 1, stats, cells), so that memory
+        is bounded by the stride. Built once for the data.
+        Heatmaps are drawn in GUI thread, so positions of rows are kept
+        apart from those used by statistics computed in background
+        '''
+
+        if self.heatmap_df is df:
+            return
+
+        cells = self.params['numLasersX'] * self.params['numLasersY']
+        start = 0
+        if self.grown(self.heatmap_df, df):
+            start = len(self.heatmap_df)
+            self.heatmap_samples, _ = sample_positions(df, self.heatmap_before)
+        else:
+            self.heatmap_samples, self.heatmap_before = sample_positions(df)
+            self.heatmap_cumulative = GrowingArray(
+                np.float64, (len(HEATMAP_STATS), cells))
+            self.heatmap_cumulative.extend(
+                np.zeros((1, len(HEATMAP_STATS), cells)))
+
+        # New rows of live data are added to the sums before the last block
+        block = start // HEATMAP_STRIDE
+        rows = slice(block * HEATMAP_STRIDE, None)
+        values = self.heat_values(df, rows)
+        blocks = -(-len(values) // HEATMAP_STRIDE)
+
+        # Combined (block, cell) key
+        key = (np.arange(len(values)) // HEATMAP_STRIDE * cells
+               + df['cell'].to_numpy()[rows])
+        cumulative = np.empty((blocks, len(HEATMAP_STATS), cells))
+        for stat in range(len(HEATMAP_STATS)):
+            cumulative[:, stat] = np.bincount(
+                key, weights=values[:, stat], minlength=blocks * cells
+                ).reshape(blocks, cells)
+        np.cumsum(cumulative, axis=0, out=cumulative)
+        cumulative += self.heatmap_cumulative.array[block]
+        self.heatmap_cumulative.truncate(block + 1)
+        self.heatmap_cumulative.extend(cumulative)
+
+        self.heatmap_df = df
+
+    def heatmap_at(self, df, position):
+        '''
+        HEATMAP_STATS of each cell before position, (stats, cells):
+        the stored sums before it and at most HEATMAP_STRIDE rows after them
+        '''
+
+        _time, _duration, before, _step = self.heatmap_samples
+        cells = df['cell'].to_numpy()
+
+        row = np.searchsorted(before, position, side='right') - 1
+        block = row // HEATMAP_STRIDE
+        sums = self.heatmap_cumulative.array[block].copy()
+
+        rows = slice(block * HEATMAP_STRIDE, row)
+        values = self.heat_values(df, rows)
+        for stat in range(len(HEATMAP_STATS)):
+            sums[stat] += np.bincount(cells[rows], weights=values[:, stat],
+                                      minlength=sums.shape[1])
+
+        # First sample of the row the position falls into and the part
+        # of its time before the position
+        if row < len(df) and position > before[row]:
+            partial = self.heat_values(df, slice(row, row + 1))[0]
+            partial[0] = position - before[row]
+            sums[:, cells[row]] += partial
+
+        return sums
+
+    def heatmap(self, start, end):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Occupancy time (s), ambulatory distance (cm) and number of rearings
+        of each map cell in [start, end], s: {stat: (numLasersY, numLasersX)}
+        '''
+
+        df = self.df
+        self.build_heatmaps(df)
+
+        first, last = samples_before(
+            self.heatmap_samples, pd.to_timedelta([start, end], unit='s').to_numpy().view(np.int64)
+            + [0, 1])
+        heat = self.heatmap_at(df, last) - self.heatmap_at(df, first)
+
+        heat[0] /= 10**9
+        heat[1] *= self.params['boxSideX'] / self.params['numLasersX']
+
+        return dict(zip(HEATMAP_STATS,
+                        heat.reshape(len(HEATMAP_STATS),
+                                     self.params['numLasersY'],
+                                     self.params['numLasersX'])))
+
+
+class ChunkedProcessing():
+    def __init__(self, params):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Incremental DataProcessing.process_raw_data over consecutive chunks
+        of raw data. State at the chunk boundary is carried to the next chunk,
+        so that the result is the same as of preprocessing the whole file.
+        '''
+
+        self.params = params
+        self.interval = params['sampleInterval'] * 10**6  # ns
+        self.backend = kernels.select_backend(params['kernelBackend'])
+
+        self.start = None  # Timestamp of the first valid row, ns
+        self.next_bin = 0  # Next bin of the sample interval to output
+
+        # Raw rows of the last bin, which may continue in the next chunk
+        self.leftover = (np.empty(0, dtype=np.int64),
+                         np.empty((0, 4)),
+                         np.empty(0, dtype=bool))
+
+        # Last output row: beams for ffill, positions and z for diff
+        self.last = None
+        # Ambulatory filter state of four beam axes
+        self.amb_state = None
+
+    def process_chunk(self, df):
+        ''' Preprocess a raw data chunk, return complete bins only '''
+
+        # Exclude rows with any of four coordinates missing
+        df = df.loc[(df.loc[:, 'x1':'y2'] != 0).all(axis=1)]
+
+        time = df.index.to_numpy().view(np.int64)
+        if self.start is None and len(time):
+            self.start = time[0]
+
+        return self.resample(
+            np.concatenate([self.leftover[0], time]),
+            np.concatenate([self.leftover[1],
+                            df.loc[:, 'x1':'y2'].to_numpy(dtype=float)]),
+            np.concatenate([self.leftover[2], df['z'].to_numpy(dtype=bool)]))
+
+    def finish(self):
+        ''' Preprocess the last bin left from the last chunk '''
+
+        return self.resample(*self.leftover, final=True)
+
+    def resample(self, time, beams, z, final=False):
+        if not len(time):
+            return None
+
+        # Resample to the sample interval
+        bins = (time - self.start) // self.interval - self.next_bin
+
+        # Keep the last bin for the next chunk
+        num_bins = bins[-1] + 1 if final else bins[-1]
+        complete = bins < num_bins
+        self.leftover = (time[~complete], beams[~complete], z[~complete])
+        if not num_bins:
+            return None
+        bins = bins[complete]
+
+        counts = np.bincount(bins, minlength=num_bins)
+        sums = np.stack([np.bincount(bins, weights=beams[complete, i],
+                                     minlength=num_bins)
+                         for i in range(4)], axis=1)
+        z = np.bincount(bins, weights=z[complete], minlength=num_bins) > 0
+
+        # Mean of each bin, forward fill empty bins
+        filled = np.maximum.accumulate(
+            np.where(counts > 0, np.arange(num_bins), -1))
+        beams = (sums[np.maximum(filled, 0)]
+                 / counts[np.maximum(filled, 0), np.newaxis])
+        if self.last is not None:
+            beams[filled < 0] = self.last['beams']
+
+        index = (np.arange(num_bins) + self.next_bin) * self.interval
+        self.next_bin += num_bins
+
+        return self.samples(index, beams, z)
+
+    def samples(self, time, beams, z, duration=None):
+        '''
+        Positions, distances and rearing of samples at time since start, ns.
+        Beams are in original bottom-left coordinates
+        '''
+
+        last_beams = beams[-1]
+
+        # Change from original bottom-left coordinates to numpy and qt top-left
+        beams = np.concatenate(
+            [beams[:, :2], self.params['numLasersY'] - beams[:, 2:] + 1],
+            axis=1)
+
+        beams_amb, self.amb_state = filter_ambulatory(beams, self.amb_state,
+                                                      self.backend)
+
+        data = {}
+        for xy, cols in zip(['x', 'y'], [slice(0, 2), slice(2, 4)]):
+            for amb, values in zip(['', '_amb'], [beams, beams_amb]):
+                # Central point of the animal in Euclidean coordinates
+                position = values[:, cols].mean(axis=1) - 0.5
+                previous = (np.nan if self.last is None
+                            else self.last[f'{xy}{amb}'])
+                data[f'{xy}{amb}'] = position
+                # Distance by each axis in beams
+                data[f'd{xy}{amb}'] = np.diff(position, prepend=previous)
+
+        # Start of rearing
+        previous = False if self.last is None else self.last['z']
+        dz = z & ~np.concatenate([[previous], z[:-1]])
+
+        self.last = {'beams': last_beams, 'z': z[-1]}
+        self.last.update({key: data[key][-1]
+                          for key in ['x', 'y', 'x_amb', 'y_amb']})
+
+        data.update({'z': z, 'dz': dz,
+                     'dist_total': np.hypot(data['dx'], data['dy']),
+                     'dist_amb': np.hypot(data['dx_amb'], data['dy_amb']),
+                     'cell': cell_index(data['x_amb'], data['y_amb'],
+                                        self.params['numLasersX'])})
+
+        df = pd.DataFrame({column: data[column].astype(dtype)
+                           for column, dtype in DATA_COLUMNS.items()},
+                          index=pd.to_timedelta(time).rename('time'))
+        if duration is not None:
+            df['duration'] = duration.astype(np.int64)
+
+        return df
+
+
+class NativeProcessing(ChunkedProcessing):
+    def __init__(self, params):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Preprocessing at the native rate of raw data, without resampling.
+        Each sample lasts until the next timestamp ('duration', ns),
+        statistics are weighted by it. The last sample of a chunk is held
+        until the next timestamp is known
+        '''
+
+        super().__init__(params)
+
+        # Last raw sample: timestamp, beams and z
+        self.held = (np.empty(0, dtype=np.int64),
+                     np.empty((0, 4)),
+                     np.empty(0, dtype=bool))
+        self.last_duration = 0
+
+    def process_chunk(self, df):
+        ''' Preprocess a raw data chunk, all samples but the last one '''
+
+        # Exclude rows with any of four coordinates missing
+        df = df.loc[(df.loc[:, 'x1':'y2'] != 0).all(axis=1)]
+
+        time = np.concatenate([self.held[0],
+                               df.index.to_numpy().view(np.int64)])
+        beams = np.concatenate([self.held[1],
+                                df.loc[:, 'x1':'y2'].to_numpy(dtype=float)])
+        z = np.concatenate([self.held[2], df['z'].to_numpy(dtype=bool)])
+        if not len(time):
+            return None
+        if self.start is None:
+            self.start = time[0]
+
+        self.held = (time[-1:], beams[-1:], z[-1:])
+        if len(time) == 1:
+            return None
+
+        duration = np.diff(time)
+        self.last_duration = duration[-1]
+
+        return self.samples(time[:-1] - self.start, beams[:-1], z[:-1],
+                            duration)
+
+    def finish(self):
+        ''' Preprocess the last sample, it lasts as long as the previous '''
+
+        time, beams, z = self.held
+        if not len(time):
+            return None
+
+        return self.samples(time - self.start, beams, z,
+                            np.array([self.last_duration]))
+
+
+class GrowingArray():
+    def __init__(self, dtype, shape=()):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Rows appended in place (array), capacity doubles when it is full,
+        so that appending takes time of the new rows only. Views of rows
+        stay valid unless the rows are truncated and appended again
+        '''
+
+        self.data = np.empty((0, *shape), dtype=dtype)
+        self.size = 0
+        self.array = self.data[:0]
+
+    def extend(self, values):
+        ''' Append rows '''
+
+        end = self.size + len(values)
+        if end > len(self.data):
+            data = np.empty((max(end, 2 * len(self.data)), *self.data.shape[1:]),
+                            dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:end] = values
+        self.size = end
+        self.array = self.data[:end]
+
+    def truncate(self, size):
+        ''' Drop rows from size on '''
+
+        self.size = min(size, self.size)
+        self.array = self.data[:self.size]
+
+
+def sample_positions(df, before=None):
+    '''
+    Timestamps of rows, duration of each row, recorded time before
+    each row (positions of rows) and step of positions, all in ns.
+    Each row of resampled data lasts one sample interval, unless
+    the trajectory is run-length encoded. Rows of native rate data
+    last until the next timestamp and can be split at any time.
+    Also the GrowingArray of positions, before is the one of data
+    that df grew from, to be extended by the new rows
+    '''
+
+    time = df.index.to_numpy().view(np.int64)
+    interval = df.attrs['interval']
+    duration = (df['duration'].to_numpy() if 'duration' in df
+                else np.broadcast_to(np.int64(interval), len(df)))
+
+    if before is None:
+        before = GrowingArray(np.int64)
+        before.extend([0])
+    before.extend(before.array[-1]
+                  + np.cumsum(duration[before.size - 1:]))
+
+    return (time, duration, before.array, interval or 1), before
+
+
+def samples_before(samples, time_ns):
+    ''' Recorded time of samples earlier than each of times, ns '''
+
+    time, duration, before, step = samples
+
+    # Last row starting before each of times
+    row = np.searchsorted(time, time_ns, side='left') - 1
+    # Its samples before the time
+    partial = np.minimum(-((time[row] - time_ns) // step) * step,
+                         duration[row])
+
+    return np.where(row >= 0, before[row] + partial, 0)
+
+
+def encode_runs(df):
+    '''
+    Run-length encoded trajectory: consecutive samples with identical
+    positions and rearing are kept as the first sample of the run
+    with the time of all its samples ('duration', ns).
+    Distances and rearing start can only occur at the first sample.
+    Runs are encoded again the same way, so that data can be encoded
+    in parts
+    '''
+
+    values = df[['x', 'y', 'x_amb', 'y_amb', 'z']].to_numpy(np.float32)
+    (time, duration, _before, _step), _ = sample_positions(df)
+
+    # A run also ends at a gap between joined parts of a recording.
+    # Native rate samples with ambulatory movement stay single, so that
+    # their time is known to bouts
+    moving = np.zeros(len(df) - 1, dtype=bool)
+    if not df.attrs['interval']:
+        moving = df['dist_amb'].to_numpy()[:-1] > 0
+    starts = np.flatnonzero(np.concatenate([
+        [True],
+        (values[1:] != values[:-1]).any(axis=1)
+        | (np.diff(time) != duration[:-1])
+        | moving
+        ]))
+
+    runs = df.iloc[starts].assign(
+        duration=np.add.reduceat(duration, starts).astype(np.int64))
+
+    return runs
+
+
+def zone_numbers(zone_coord):
+    '''
+    Zones of a zone map. Each cell holds a bitmask of zones it belongs to,
+    zone n is bit n - 1
+    '''
+
+    used = int(np.bitwise_or.reduce(zone_coord, axis=None))
+
+    return np.array([bit + 1 for bit in range(used.bit_length())
+                     if used >> bit & 1], dtype=int)
+
+
+def zone_membership(masks, zones):
+    ''' Whether each of zone masks includes each of zones, (masks, zones) '''
+
+    return (masks[:, np.newaxis] >> (zones - 1)) & 1 == 1
+
+
+def zone_columns(masks, zones):
+    '''
+    Output columns each of zone masks is summed to, (masks, whole field
+    + zones): the whole field (including non-selected area) and zones
+    the mask includes
+    '''
+
+    return np.hstack([np.ones((len(masks), 1)),
+                      zone_membership(masks, zones)])
+
+
+def nan_mean(values):
+    ''' Mean over the first axis, ignoring NaN, NaN if all are NaN '''
+
+    counts = (~np.isnan(values)).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nansum(values, axis=0) / counts
+
+
+def cell_index(x_amb, y_amb, num_lasers_x):
+    '''
+    Flat index of the map cell of each ambulatory position,
+    zone of a timestamp is zoneCoord.ravel()[cell]
+    '''
+
+    # Zone is determined according to the ambulatory position
+    return y_amb.astype(np.int32) * num_lasers_x + x_amb.astype(np.int32)
+
+
+def filter_ambulatory(beams, state=None, backend='numpy'):
+    '''
+    Ambulatory positions along all beam axes at once, beams are (n, axes).
+    A change of position is accepted unless it reverses the previous change
+    of the same axis (beam flickering back and forth).
+    State (last values, last changes, last ambulatory values) continues
+    filtering from a previous call. Return positions and the new state.
+    '''
+
+    if backend == 'numba':
+        return kernels.filter_ambulatory(beams, state)
+
+    n, axes = beams.shape
+    if state is None:
+        state = (np.full(axes, np.nan),) * 3
+    last_value, last_diff, last_amb = state
+
+    rows = np.arange(n)[:, np.newaxis]
+    cols = np.arange(axes)
+
+    diff = np.diff(beams, axis=0, prepend=last_value[np.newaxis])
+    changed = diff != 0  # First NaN is a change too
+
+    # Row of the latest change of each axis up to each row
+    last_change = np.maximum.accumulate(np.where(changed, rows, -1), axis=0)
+    # Change preceding the one in each row
+    previous_change = np.vstack([np.full((1, axes), -1), last_change[:-1]])
+    previous_diff = np.where(previous_change >= 0,
+                             diff[previous_change, cols], last_diff)
+    accepted = changed & ~(diff + previous_diff == 0)
+
+    last_accepted = np.maximum.accumulate(np.where(accepted, rows, -1), axis=0)
+    amb = np.where(last_accepted >= 0, beams[last_accepted, cols], last_amb)
+
+    last_diff = np.where(last_change[-1] >= 0,
+                         diff[last_change[-1], cols], last_diff)
 
-        self.data = data
-        return data
+    return amb, (beams[-1], last_diff, amb[-1])
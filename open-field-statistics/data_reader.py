@@ -0,0 +1,512 @@
+import io
+import os
+import re
+import csv
+import mmap
+import inspect
+import zipfile
+import collections
+import multiprocessing
+from xml.etree import ElementTree
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+RAW_COLUMNS = ['time', 'x1', 'x2', 'y1', 'y2', 'z']
+RAW_DTYPES = {'time': str,
+              'x1': np.int16, 'x2': np.int16,
+              'y1': np.int16, 'y2': np.int16,
+              'z': bool}
+SNIFF_SIZE = 64 * 1024  # Bytes from the head of the file used for sniffing
+SEPARATORS = ';,\t'
+CHUNKED_SIZE = 32 * 1024**2  # Files larger than this are read in chunks
+BLOCK_SIZE = 16 * 1024**2  # Bytes of large file parsed by one process
+READ_AHEAD = 4  # Blocks parsed ahead, bounds memory of blocks in flight
+DAY_NS = 24 * 3600 * 10**9
+# Bytes of a timestamp: 'HH:MM:SS.' and fractional digits down to nanoseconds
+TIME_WIDTH = 18
+FRACTION_SCALE = 10 ** np.arange(8, -1, -1, dtype=np.int64)
+
+# Excel workbooks
+XLSX_MAGIC = b'PK\x03\x04'  # Zip archive
+XLS_MAGIC = b'\xd0\xcf\x11\xe0'  # Legacy binary workbook, not supported
+XLSX_CHUNK_ROWS = 100_000
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = ('{http://schemas.openxmlformats.org/officeDocument/2006/'
+               'relationships}')
+
+
+class DataReader():
+    def __init__(self, window):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        self.window = window
+
+        # Fraction of the file parsed by read_raw_data_chunks, if known
+        self.read_fraction = None
+
+    def detect_format(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Raw data file format from its first bytes and extension '''
+
+        with open(path, 'rb') as file:
+            magic = file.read(4)
+
+        if magic == XLSX_MAGIC:
+            return 'xlsx'
+        if magic == XLS_MAGIC or path.lower().endswith('.xls'):
+            raise ValueError('Excel 97-2003 workbooks (.xls) are not supported.\n'
+                             + 'Save the file as Excel Workbook (.xlsx) or CSV.')
+        # Delimited text, separator is found by sniffing
+        return 'text'
+
+    def sniff_dialect(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Find separator and decimal mark from the head of the file '''
+
+        with open(path, 'r', newline='') as file:
+            sample = file.read(SNIFF_SIZE)
+
+        # Sniff only complete lines
+        if len(sample) == SNIFF_SIZE and '\n' in sample:
+            sample = sample[:sample.rindex('\n')]
+
+        try:
+            sep = csv.Sniffer().sniff(sample, delimiters=SEPARATORS).delimiter
+        except csv.Error:
+            # Sniffer fails on files with one column only, fall back to
+            # the separator of the third-party software
+            sep = ';'
+
+        # Timestamps always have decimal point, so check beam columns only.
+        # Beams are integer unless some export wrote them as fractions,
+        # with decimal comma only possible when comma is not the separator
+        decimal = None
+        lines = sample.splitlines()[1:]
+        for line in lines:
+            for value in line.split(sep)[1:]:
+                match = re.fullmatch(r'-?\d+([.,])\d+', value.strip())
+                if match:
+                    decimal = match.group(1)
+                    break
+            if decimal:
+                break
+
+        return sep, decimal
+
+    def is_large(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Large files are read and preprocessed in chunks '''
+
+        return os.path.getsize(path) > CHUNKED_SIZE
+
+    def csv_options(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Arguments of pd.read_csv for the raw data file '''
+
+        sep, decimal = self.sniff_dialect(path)
+
+        dtype = RAW_DTYPES.copy()
+        # Fractional beam values
+        if decimal:
+            dtype.update({ax: np.float32 for ax in ['x1', 'x2', 'y1', 'y2']})
+
+        return {'sep': sep,
+                'decimal': decimal or '.',
+                'engine': 'c',
+                'names': RAW_COLUMNS, 'header': 0,
+                'dtype': dtype}
+
+    def read_events(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Event file: timestamp and optional label in each row. Timestamps
+        are seconds since the start of the recording, or clock time of the
+        day 'HH:MM:SS.f'. Return events with time in ns and label,
+        attrs['clock'] tells if it is clock time
+        '''
+
+        with open(path, 'r', newline='') as file:
+            sample = file.read(SNIFF_SIZE)
+            file.seek(0)
+            try:
+                sep = csv.Sniffer().sniff(sample, delimiters=SEPARATORS).delimiter
+            except csv.Error:
+                sep = ';'
+            rows = [[value.strip() for value in row]
+                    for row in csv.reader(file, delimiter=sep)
+                    if row and row[0].strip()]
+
+        time = pd.Series([row[0] for row in rows], dtype=str)
+        label = pd.Series([row[1] if len(row) > 1 and row[1] else 'event'
+                           for row in rows], dtype=str)
+
+        # Seconds, with decimal comma unless comma separates values
+        seconds = pd.to_numeric(time if sep == ',' else
+                                time.str.replace(',', '.'), errors='coerce')
+        clock = time.str.contains(':')
+        # Column names in the first row
+        if len(time) and not (clock[0] or pd.notna(seconds[0])):
+            time, label = time[1:], label[1:]
+            seconds, clock = seconds[1:], clock[1:]
+
+        if clock.all() and len(time):
+            ns = parse_time(time.to_numpy())
+        elif seconds.notna().all():
+            ns = (seconds.to_numpy() * 10**9).round().astype(np.int64)
+        else:
+            raise ValueError('Event times should be either seconds since the '
+                             + 'start of the recording or clock time '
+                             + '(HH:MM:SS.f), one event in each row.')
+
+        events = pd.DataFrame({'time': ns, 'label': label.to_numpy()})
+        events.attrs['clock'] = bool(clock.all() and len(time))
+
+        return events
+
+    def read_raw_data(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Read raw data file, text with the fast C parser '''
+
+        if self.detect_format(path) == 'xlsx':
+            return pd.concat(read_xlsx(path))
+
+        df = pd.read_csv(path, **self.csv_options(path))
+        df['time'] = parse_time(df['time'].to_numpy())
+
+        return set_time_index(df)
+
+    def read_raw_data_chunks(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Iterate over raw data file in blocks of about BLOCK_SIZE bytes.
+        Blocks are parsed in parallel on a process pool and returned in order
+        '''
+
+        # Workbook is streamed row by row instead
+        self.read_fraction = None
+        if self.detect_format(path) == 'xlsx':
+            yield from read_xlsx(path)
+            return
+
+        options = self.csv_options(path)
+        workers = min(os.cpu_count() or 1, READ_AHEAD)
+        size = os.path.getsize(path)
+
+        # Reading runs in a thread of the Qt application, forking the
+        # multithreaded process could deadlock the workers
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            # Parse a few blocks ahead, but not the whole file at once
+            pending = collections.deque()
+            last = None  # Continue timestamps of the previous block
+            try:
+                for start, end in split_blocks(path):
+                    pending.append((executor.submit(parse_block, path,
+                                                    start, end, options),
+                                    end))
+                    if len(pending) < READ_AHEAD:
+                        continue
+                    df, last = self.next_block(pending, last, size)
+                    yield df
+
+                while pending:
+                    df, last = self.next_block(pending, last, size)
+                    yield df
+            # Do not parse the rest if reading was stopped before the end
+            finally:
+                executor.shutdown(cancel_futures=True)
+
+    def next_block(self, pending, last, size):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Wait for the first pending block, continue its timestamps.
+        Fraction of the file read so far is kept for progress reporting
+        '''
+
+        future, end = pending.popleft()
+        df = set_time_index(future.result(), last)
+        self.read_fraction = end / size
+
+        return df, df.index[-1].value if len(df) else last
+
+    def tail(self, path):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Follow raw data file which is still being written '''
+
+        return DataTail(path, self)
+
+
+class DataTail():
+    def __init__(self, path, reader):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        self.path = path
+        self.reader = reader
+        self.options = None  # Sniffed once the first data row is written
+
+        self.offset = 0  # Bytes already read
+        self.last = None  # Last timestamp already read
+
+    def read(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Return rows appended since the previous read, None if none '''
+
+        with open(self.path, 'rb') as file:
+            file.seek(self.offset)
+            data = file.read()
+
+        # The last line may be not completely written yet, read it next time
+        end = data.rfind(b'\n') + 1
+        if not end:
+            return None
+
+        # Separator and decimal mark can only be told from a data row,
+        # the file may be empty or hold only the header when it is opened
+        if self.options is None:
+            if data.count(b'\n') < 2:
+                return None
+            self.options = self.reader.csv_options(self.path)
+
+        header = 0 if self.offset == 0 else None
+        self.offset += end
+
+        df = pd.read_csv(io.BytesIO(data[:end]),
+                         **{**self.options, 'header': header})
+        if df.empty:
+            return None
+
+        df['time'] = parse_time(df['time'].to_numpy())
+        df = set_time_index(df, self.last)
+        self.last = df.index[-1].value
+
+        return df
+
+
+def split_blocks(path):
+    ''' Byte ranges of the memory-mapped file split at line ends '''
+
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            start = data.find(b'\n') + 1  # Skip header
+            while 0 < start < size:
+                end = data.find(b'\n', min(start + BLOCK_SIZE, size) - 1)
+                end = size if end < 0 else end + 1
+                yield start, end
+                start = end
+
+
+def parse_block(path, start, end, options):
+    ''' Parse a byte range of the raw data file in a worker process '''
+
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            block = data[start:end]
+
+    df = pd.read_csv(io.BytesIO(block), **{**options, 'header': None})
+    df['time'] = parse_time(df['time'].to_numpy())
+
+    return df
+
+
+def read_xlsx(path):
+    '''
+    Iterate over the first sheet of xlsx workbook in chunks of XLSX_CHUNK_ROWS
+    rows. Sheet XML is parsed as a stream, without building the workbook
+    '''
+
+    with zipfile.ZipFile(path) as archive:
+        strings = read_xlsx_strings(archive)
+
+        rows = []
+        header = True
+        last = None  # Continue timestamps of the previous chunk
+        with archive.open(xlsx_sheet_path(archive)) as sheet:
+            for event, element in ElementTree.iterparse(sheet,
+                                                        events=('start', 'end')):
+                # Parent of rows, cleared after each row to keep memory bounded
+                if event == 'start':
+                    if element.tag == f'{XLSX_NS}sheetData':
+                        sheet_data = element
+                    continue
+                if element.tag != f'{XLSX_NS}row':
+                    continue
+
+                if not header:
+                    rows.append(read_xlsx_row(element, strings))
+                header = False
+                sheet_data.clear()
+
+                if len(rows) == XLSX_CHUNK_ROWS:
+                    df = xlsx_rows_to_df(rows, last)
+                    last = df.index[-1].value
+                    rows = []
+                    yield df
+
+        if rows or last is None:
+            yield xlsx_rows_to_df(rows, last)
+
+
+def xlsx_sheet_path(archive):
+    ''' Path of the first worksheet inside xlsx archive '''
+
+    try:
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        sheet_id = (workbook.find(f'{XLSX_NS}sheets/{XLSX_NS}sheet')
+                   .get(f'{XLSX_REL_NS}id'))
+        relations = ElementTree.fromstring(
+            archive.read('xl/_rels/workbook.xml.rels'))
+        target = next(relation.get('Target') for relation in relations
+                      if relation.get('Id') == sheet_id)
+    # Unusual workbook, try the default location
+    except (KeyError, AttributeError, StopIteration):
+        return 'xl/worksheets/sheet1.xml'
+
+    # Target is relative to 'xl' folder, unless absolute
+    if target.startswith('/'):
+        return target[1:]
+    return f'xl/{target}'
+
+
+def read_xlsx_strings(archive):
+    ''' Table of strings, referenced by index from the cells of xlsx '''
+
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+
+    strings = []
+    with archive.open('xl/sharedStrings.xml') as file:
+        for _event, element in ElementTree.iterparse(file):
+            if element.tag == f'{XLSX_NS}si':
+                strings.append(''.join(element.itertext()))
+                element.clear()
+
+    return strings
+
+
+def read_xlsx_row(row, strings):
+    ''' Values of the first six cells of xlsx row element '''
+
+    values = [None] * len(RAW_COLUMNS)
+    for i, cell in enumerate(row.iter(f'{XLSX_NS}c')):
+        # Cell reference like 'B12', empty cells may be skipped in the row
+        reference = cell.get('r')
+        if reference:
+            letters = reference.rstrip('0123456789')
+            i = 0
+            for letter in letters:
+                i = i * 26 + ord(letter) - ord('A') + 1
+            i -= 1
+        if i >= len(RAW_COLUMNS):
+            continue
+
+        cell_type = cell.get('t', 'n')
+        if cell_type == 'inlineStr':
+            values[i] = ''.join(cell.find(f'{XLSX_NS}is').itertext())
+            continue
+        value = cell.find(f'{XLSX_NS}v')
+        if value is None:
+            continue
+        if cell_type == 's':
+            values[i] = strings[int(value.text)]
+        elif cell_type == 'b':
+            values[i] = value.text == '1'
+        elif cell_type == 'n':
+            values[i] = float(value.text)
+        else:
+            values[i] = value.text
+
+    return values
+
+
+def xlsx_rows_to_df(rows, last=None):
+    ''' Values of xlsx rows to the same dataframe as from .csv file '''
+
+    df = pd.DataFrame(rows, columns=RAW_COLUMNS)
+
+    # Timestamps are either text or Excel time - fraction of the day
+    is_text = df['time'].map(type) == str
+    time = np.zeros(len(df), dtype=np.int64)
+    time[is_text] = parse_time(df.loc[is_text, 'time'].to_numpy())
+    time[~is_text] = np.round(df.loc[~is_text, 'time'].astype(float).to_numpy()
+                             % 1 * DAY_NS)
+    df['time'] = time
+
+    for ax in ['x1', 'x2', 'y1', 'y2']:
+        df[ax] = pd.to_numeric(df[ax])
+        integer = (df[ax] % 1 == 0).all()
+        df[ax] = df[ax].astype(np.int16 if integer else np.float32)
+
+    # Booleans or 'TRUE'/'FALSE' text
+    df['z'] = df['z'].astype(str).str.upper().isin(['TRUE', '1', '1.0'])
+
+    return set_time_index(df, last)
+
+
+def set_time_index(df, last=None):
+    '''
+    Replace time column, parsed as time of the day, with timedelta index.
+    Last is the last timestamp if df continues previous data
+    '''
+
+    time = pd.to_timedelta(continue_days(df['time'].to_numpy(), last))
+
+    return df.drop(columns='time').set_axis(time.rename('time'), axis='index')
+
+
+def parse_time(values):
+    ''' Clock timestamps 'HH:MM:SS.fffffff' to int64 nanoseconds of the day '''
+
+    chars = np.asarray(values, dtype=f'S{TIME_WIDTH}')
+    codes = (chars.view(np.uint8).reshape(len(chars), TIME_WIDTH)
+             .astype(np.int8) - ord('0'))
+    colon = ord(':') - ord('0')
+
+    # Pad one-digit hours with zero
+    short = codes[:, 1] == colon
+    if short.any():
+        codes[short, 1:] = codes[short, :-1]
+        codes[short, 0] = 0
+
+    # Some other format, let pandas guess it
+    if not ((codes[:, 2] == colon).all() and (codes[:, 5] == colon).all()):
+        return (pd.to_timedelta(pd.Series(values, dtype=str).str.strip())
+                .to_numpy().view(np.int64))
+
+    hms = codes[:, :8].astype(np.int64)
+    ns = ((hms[:, 0] * 10 + hms[:, 1]) * 3600
+          + (hms[:, 3] * 10 + hms[:, 4]) * 60
+          + (hms[:, 6] * 10 + hms[:, 7])) * 10**9
+    # Digits after the decimal point, zeros after the end of the string
+    fraction = codes[:, 9:]
+    fraction = np.where((fraction >= 0) & (fraction <= 9), fraction, 0)
+
+    return ns + fraction.astype(np.int64) @ FRACTION_SCALE
+
+
+def continue_days(ns, last=None):
+    '''
+    Time of the day to time since midnight of the first day, so that
+    a recording crossing midnight keeps increasing.
+    Last is the last timestamp if ns continue previous ones
+    '''
+
+    # Clock goes back by more than half a day only at midnight
+    previous = ns[:1] if last is None else [last % DAY_NS]
+    rollover = np.diff(ns, prepend=previous) < -DAY_NS // 2
+    days = np.cumsum(rollover) + (0 if last is None else last // DAY_NS)
+
+    return ns + days * DAY_NS
@@ -9,7 +9,7 @@ from PyQt6.QtWidgets import (
     QRubberBand
 )
 from PyQt6.QtCore import (
-    Qt, pyqtSlot, QPoint, QPointF, QRect, QLineF, QSignalBlocker
+    Qt, pyqtSlot, QPoint, QPointF, QRect, QRectF, QLineF, QSignalBlocker
     )
 from PyQt6.QtGui import (
     QIcon, QPixmap, QImage, QPainter, QPen, QColor, QPolygonF
@@ -17,6 +17,7 @@ from PyQt6.QtGui import (
 from PyQt6 import sip
 
 from color_style import ColorStyle
+from data_processing import zone_numbers
 
 
 class MapWidget(QLabel):
@@ -27,6 +28,7 @@ class MapWidget(QLabel):
 
         self.window = window
         self.params = self.window.settings.params
+        # Bitmask of zones of each cell, zone n is bit n - 1
         self.zoneCoord = np.zeros((self.params['numLasersY'],
                                    self.params['numLasersX']),
                                   dtype=int)
@@ -53,7 +55,9 @@ class MapWidget(QLabel):
 
         self.mapMode = 'total'
         self.mapModeBox = QComboBox()
-        self.mapModeBox.addItems(['Total movements', 'Ambulatory movements'])
+        self.mapModeBox.addItems(['Total movements', 'Ambulatory movements',
+                                  'Occupancy heatmap', 'Distance heatmap',
+                                  'Rearings heatmap'])
         self.mapModeBox.setCurrentText('Total movements')
         self.mapModeBox.currentTextChanged.connect(self.changeMapMode)
 
@@ -74,6 +78,13 @@ class MapWidget(QLabel):
             self.mapMode = 'total'
         elif text == 'Ambulatory movements':
             self.mapMode = 'ambulatory'
+        # Heatmap modes are named as statistics of DataProcessing.heatmap
+        elif text == 'Occupancy heatmap':
+            self.mapMode = 'time'
+        elif text == 'Distance heatmap':
+            self.mapMode = 'distance'
+        elif text == 'Rearings heatmap':
+            self.mapMode = 'rearings'
 
         self.updateMapPath(
             self.window.time.timeParams['startSelected'],
@@ -103,10 +114,10 @@ class MapWidget(QLabel):
         # Set map widget's size with a 2 px margin for border line rendering
         self.setFixedSize(self.mapSideX + 2, self.mapSideY + 2)
 
-        zones = np.unique(self.zoneCoord)
-        zones = zones[zones > 0]
-        self.numZones = len(zones)
-        # Holds newly selected zone values before adding them
+        # New zones get bits above the highest used one, zones of loaded
+        # parameters may be numbered with gaps
+        self.numZones = int(zone_numbers(self.zoneCoord).max(initial=0))
+        # Holds the number of newly selected zone before adding it
         # to global zoneCoord with the 'Add zone" button
         self.bufferZoneCoord = np.zeros((self.params['numLasersY'],
                                          self.params['numLasersX']),
@@ -117,6 +128,20 @@ class MapWidget(QLabel):
 
         self.createMapButtons()
 
+    def resizeMap(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Redraw map for new field size, keeping zones and path '''
+
+        zoneCoord = self.zoneCoord.copy()
+        self.deleteMapButtons()
+        self.zoneCoord[:, :] = zoneCoord
+        self.loadMap()
+
+        if self.window.file.hasDataFile:
+            self.updateMapPath(self.window.time.timeParams['startSelected'],
+                               self.window.time.timeParams['endSelected'])
+
     def drawMap(self):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
@@ -173,21 +198,25 @@ class MapWidget(QLabel):
         zoneCoord = self.zoneCoord.copy()
         # ...updated with newly selected areas that are not yet saved
         hasValues = np.where(self.bufferZoneCoord)
-        zoneCoord[hasValues] = self.bufferZoneCoord[hasValues]
+        zoneCoord[hasValues] |= 1 << (self.bufferZoneCoord[hasValues] - 1)
 
         self.zoneLayer.fill(Qt.GlobalColor.transparent)
 
         zonePainter = QPainter(self.zoneLayer)
 
-        # Fill cells with color
+        # Fill cells with color.
+        # Cells of overlapping zones are filled with each of their colors
         for i in range(self.numLasersY):
             for j in range(self.numLasersX):
-                zone = zoneCoord[i][j]
-                zoneColor = QColor(*ColorStyle.zoneColors[zone], int(0.3*255))
-                zonePainter.setBrush(zoneColor)
-                x = self.cellX * j
-                y = self.cellY * i
-                zonePainter.drawRect(x, y, self.cellX, self.cellY)
+                zones = [zone for zone in range(1, len(ColorStyle.zoneColors))
+                         if zoneCoord[i][j] >> (zone - 1) & 1]
+                for zone in zones or [0]:
+                    zoneColor = QColor(*ColorStyle.zoneColors[zone],
+                                       int(0.3*255))
+                    zonePainter.setBrush(zoneColor)
+                    x = self.cellX * j
+                    y = self.cellY * i
+                    zonePainter.drawRect(x, y, self.cellX, self.cellY)
 
         zonePainter.end()
 
@@ -196,22 +225,44 @@ class MapWidget(QLabel):
     def updateMapPath(self, start, end):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
-        ''' Draw path in Selected time '''
-
-        start = pd.to_timedelta(start, unit='s')
-        end = pd.to_timedelta(end, unit='s')
+        ''' Draw path or heatmap in Selected time '''
 
         self.pathLayer.fill(Qt.GlobalColor.transparent)
 
         pathPainter = QPainter(self.pathLayer)
 
-        pathPainter.setPen(QPen(Qt.GlobalColor.red, 2))
-        pathPainter.drawPolyline(self.makePath(self.window.stat.df[start:end]))
+        if self.mapMode in ['total', 'ambulatory']:
+            start = pd.to_timedelta(start, unit='s')
+            end = pd.to_timedelta(end, unit='s')
+            pathPainter.setPen(QPen(Qt.GlobalColor.red, 2))
+            pathPainter.drawPolyline(self.makePath(self.window.stat.df[start:end]))
+        else:
+            self.drawHeatmap(pathPainter, start, end)
 
         pathPainter.end()
 
         self.updateMap()
 
+    def drawHeatmap(self, painter, start, end):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Color cells by the statistic of map mode, the highest is opaque '''
+
+        heat = self.window.stat.heatmap(start, end)[self.mapMode]
+        if not heat.max() > 0:
+            return
+
+        image = np.zeros(heat.shape + (4,), dtype=np.uint8)
+        image[:, :, 0] = 255  # Red, as path
+        image[:, :, 3] = heat / heat.max() * 220
+        image = QImage(image.tobytes(), self.numLasersX, self.numLasersY,
+                       self.numLasersX * 4, QImage.Format.Format_RGBA8888)
+
+        # One image pixel for each cell
+        painter.drawImage(QRectF(0, 0, self.cellX * self.numLasersX,
+                                 self.cellY * self.numLasersY),
+                          image)
+
     def makePath(self, df):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
@@ -275,9 +326,10 @@ class MapWidget(QLabel):
                 numNewZones = 2 or 3
         '''
 
-        # Save newly selected areas to global zoneCoord
+        # Save newly selected areas to global zoneCoord.
+        # They can overlap existing zones
         hasValues = np.where(self.bufferZoneCoord)
-        self.zoneCoord[hasValues] = self.bufferZoneCoord[hasValues]
+        self.zoneCoord[hasValues] |= 1 << (self.bufferZoneCoord[hasValues] - 1)
         # Clear selected area buffer
         self.bufferZoneCoord[...] = 0
 
@@ -319,34 +371,44 @@ class MapWidget(QLabel):
         nX = self.numLasersX
         nY = self.numLasersY
 
-        numNewZones = 2  # For halves or center/periphery
+        # Numbers of new zones in each cell, 1 is the first new zone
+        newZones = np.zeros((nY, nX), dtype=int)
 
         # Split field vertically into two halves
         if newBtn == 'vertical_halves':
-            self.zoneCoord[:, :nX//2] = 1
-            self.zoneCoord[:, nX//2:] = 2
+            newZones[:, :nX//2] = 1
+            newZones[:, nX//2:] = 2
 
         # Split field horizontally into two halves
         elif newBtn == 'horizontal_halves':
-            self.zoneCoord[:nY//2, :] = 1
-            self.zoneCoord[nY//2:, :] = 2
+            newZones[:nY//2, :] = 1
+            newZones[nY//2:, :] = 2
 
         # Split field into central and peripheral zones
         elif newBtn == 'wall':
-            self.zoneCoord[:, :] = 2  # Walls
+            newZones[:, :] = 2  # Walls
             wall = int(np.ceil(min(nX, nY) / 4))
-            self.zoneCoord[wall : -wall, wall : -wall] = 1  # Center
+            newZones[wall : -wall, wall : -wall] = 1  # Center
 
         elif newBtn == 'wall_corners':
-            self.zoneCoord[:, :] = 3  # Corners
+            newZones[:, :] = 3  # Corners
             wall = int(np.ceil(min(nX, nY) / 4))
-            self.zoneCoord[wall : -wall, :] = 2  # Walls
-            self.zoneCoord[:, wall : -wall] = 2
-            self.zoneCoord[wall : -wall, wall : -wall] = 1  # Center
-            numNewZones = 3
+            newZones[wall : -wall, :] = 2  # Walls
+            newZones[:, wall : -wall] = 2
+            newZones[wall : -wall, wall : -wall] = 1  # Center
+
+        numNewZones = int(newZones.max())
+        # Maximum 10 zones
+        if self.numZones + numNewZones > 10:
+            return
+
+        # Predefined zones are added after existing zones and can overlap
+        # them, e.g. center and one of vertical halves
+        self.bufferZoneCoord[...] = 0
+        self.zoneCoord |= np.where(newZones > 0,
+                                   1 << (newZones + self.numZones - 1), 0)
 
         self.updateMapZones()
-        self.numZones = 0
         self.addNewZone(numNewZones=numNewZones)
 
     def mapBtnToggled(self, checked, x=-1, y=-1, s=-1):
@@ -1,15 +1,82 @@
 import os
+import re
 import copy
 import json
 import inspect
+import traceback
 import pandas as pd
 import numpy as np
 
-from PyQt6.QtWidgets import (QFileDialog, QMessageBox,
+from PyQt6.QtWidgets import (QFileDialog, QMessageBox, QProgressDialog,
                              QLabel, QPushButton)
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QTimer, QThread, pyqtSignal
 from PyQt6.QtGui import QFontMetrics, QAction
 
+from data_reader import DataReader
+from data_cache import DataCache
+
+
+LIVE_INTERVAL = 1000  # Refresh rate of live recording, ms
+PROGRESS_DELAY = 500  # Progress dialog is not shown for faster loading, ms
+
+
+class LoadCancelled(Exception):
+    ''' Loading of raw data file was cancelled from progress dialog '''
+
+
+class LoadThread(QThread):
+    '''
+    Read and preprocess raw data file in background, so that the window
+    stays responsive. Map and table are updated by File when it is loaded
+    '''
+
+    progress = pyqtSignal(str, int)  # Stage, percent or -1 if unknown
+    loaded = pyqtSignal(object, int, int)  # Preprocessed data, maxX, maxY
+    failed = pyqtSignal(str)
+
+    def __init__(self, file, loadDataFiles, defaultTimeVariables,
+                 fitTimeVariables):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        super().__init__(file.window)
+
+        self.file = file
+        self.loadDataFiles = loadDataFiles
+        self.defaultTimeVariables = defaultTimeVariables
+        self.fitTimeVariables = fitTimeVariables
+
+        self.cancelled = False
+
+    def run(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        try:
+            df, (maxX, maxY) = self.file.readRecording(self.loadDataFiles,
+                                                       self.reportProgress)
+        except LoadCancelled:
+            return
+        # File could not be read or parsed. Exceptions must not escape run(),
+        # they would abort the app
+        except Exception as error:
+            traceback.print_exc()
+            self.failed.emit(str(error) or type(error).__name__)
+            return
+
+        self.loaded.emit(df, maxX, maxY)
+
+    def reportProgress(self, stage, fraction=None):
+        ''' Called between stages and chunks, stops reading if cancelled '''
+
+        if self.cancelled:
+            raise LoadCancelled
+
+        self.progress.emit(stage, -1 if fraction is None else round(fraction * 100))
+
+    def cancel(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        self.cancelled = True
+
 
 class File:
     def __init__(self, window):
@@ -20,9 +87,29 @@ class File:
 
         self.hasDataFile = False
 
-        self.dataFilters = '''CSV (comma delimited) (*.csv)'''#;;
-                              # Text (tab delimited) (*.txt);;
-                              # Excel Workbook (*.xlsx)'''  #TODO
+        # Raw data file being read in background
+        self.loadThread = None
+        self.progressDialog = None
+
+        self.reader = DataReader(self.window)
+        self.cache = DataCache(self.window)
+
+        # Refresh map and table while following a live recording
+        self.liveTimer = QTimer()
+        self.liveTimer.timeout.connect(self.updateLiveData)
+
+        # Format of input file is detected from its content
+        self.dataFilters = ('Raw data (*.csv *.txt *.tsv *.xlsx);;'
+                            + 'CSV (comma delimited) (*.csv);;'
+                            + 'Text (tab delimited) (*.txt *.tsv);;'
+                            + 'Excel Workbook (*.xlsx)')
+        self.textDataFilters = ('Raw data (*.csv *.txt *.tsv);;'
+                                + 'CSV (comma delimited) (*.csv);;'
+                                + 'Text (tab delimited) (*.txt *.tsv)')
+        self.outputFilters = 'CSV (comma delimited) (*.csv)'
+        self.eventFilters = ('Events (*.csv *.txt *.tsv);;'
+                             + 'CSV (comma delimited) (*.csv);;'
+                             + 'Text (tab delimited) (*.txt *.tsv)')
 
         self.setButtons()
 
@@ -46,11 +133,14 @@ class File:
 
         fileMenu = menu.addMenu('File')
 
-        files = ['loadData', 'loadParams', 'saveData', 'saveParams', 'saveMap']
+        files = ['loadData', 'followData', 'loadEvents', 'loadParams',
+                 'saveData', 'saveParams', 'saveMap']
         items = ['caption', 'action', 'slot']
         self.fileItems = pd.DataFrame(index=files, columns=items)
         self.fileItems.loc[:, ['caption', 'slot']] = [
             ['Load raw data', self.loadData],
+            ['Follow live recording', self.followData],
+            ['Load events', self.loadEvents],
             ['Load parameters', self.loadParams],
             ['Save statistics', self.saveData],
             ['Save parameters', self.saveParams],
@@ -71,56 +161,90 @@ class File:
 
         fileMenu.insertSeparator(self.fileItems.loc['saveData', 'action'])
 
+        # Stays checked while live recording is followed
+        self.fileItems.loc['followData', 'action'].setCheckable(True)
+
         # Do not allow to save output data before raw data were loaded
         self.fileItems.loc['saveData', 'action'].setDisabled(True)
         self.fileItems.loc['saveMap', 'action'].setDisabled(True)
 
-    def loadData(self, loadDataFile=None, defaultTimeVariables=True):
+    def loadData(self, loadDataFiles=None, defaultTimeVariables=True,
+                 fitTimeVariables=False):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
-        ''' Load raw data file, get statistics, update map and table '''
+        '''
+        Load raw data file, get statistics, update map and table.
+        Several files selected together are parts of one recording
+        '''
 
         # Open FileDialog if it is original 'Load raw data' call.
         # Do not open FileDialog for reloading the same data file for new params
         # isNewDataFile = False
-        if not loadDataFile:
-            loadDataFile, filter = QFileDialog.getOpenFileName(
+        if not loadDataFiles:
+            loadDataFiles, filter = QFileDialog.getOpenFileNames(
                 parent=self.window,
                 caption=self.fileItems.loc['loadData', 'caption'],
                 directory=self.params['dirs']['loadData'],
                 filter=self.dataFilters
                 )
             # FileDialog was exited with cancel
-            if not loadDataFile:
+            if not loadDataFiles:
                 return
+            loadDataFiles = self.orderParts(loadDataFiles)
             # isNewDataFile = True
-        self.hasDataFile = True
+        self.stopFollowing()
+        # Only the last selected file is loaded
+        self.cancelLoading()
+
+        thread = self.loadThread = LoadThread(self, loadDataFiles,
+                                              defaultTimeVariables,
+                                              fitTimeVariables)
+        thread.progress.connect(self.updateProgress)
+        thread.loaded.connect(
+            lambda df, maxX, maxY: self.showData(thread, df, maxX, maxY))
+        thread.failed.connect(
+            lambda error: self.loadFailed(thread, error))
+        thread.finished.connect(lambda: self.loadStopped(thread))
+
+        self.progressDialog = QProgressDialog(
+            'Parsing', 'Cancel', 0, 100, self.window)
+        self.progressDialog.setWindowTitle(
+            self.fileItems.loc['loadData', 'caption'])
+        self.progressDialog.setWindowModality(Qt.WindowModality.WindowModal)
+        self.progressDialog.setMinimumDuration(PROGRESS_DELAY)
+        self.progressDialog.setAutoReset(False)
+        self.progressDialog.setAutoClose(False)
+        self.progressDialog.canceled.connect(self.cancelLoading)
+
+        thread.start()
+
+    def showData(self, thread, df, maxX, maxY):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
-        raw_df = pd.read_csv(
-            loadDataFile,
-            sep=None,   # Uses 'csv.Sniffer' for decimal separator,
-            # needs python engine
-            engine='python',
-            # engine='c',  # Needs specified decimal separator
-            parse_dates=[0], date_format='%H:%M:%S.%f',
-            names=['time', 'x1', 'x2', 'y1', 'y2', 'z'], header=0,
-            index_col=0
-            )
+        ''' Raw data file was read and preprocessed, update map and table '''
 
-        # Check if data correspond to field settings
-        maxX, maxY = self.window.stat.checkDataToField(raw_df)
-        # Show warning message and abort if not
+        # Loading was cancelled after the data were sent
+        if thread is not self.loadThread:
+            return
+
+        # Show warning message and abort if data do not fit
         if maxX or maxY:
+            self.finishLoading()
             self.incorrectData(maxX, maxY)
             self.hasDataFile = False
             return
 
-        self.window.stat.process_raw_data(raw_df)
+        self.window.stat.df = df
+        self.hasDataFile = True
 
         # If new data - update time variables to default (based on loaded data)
-        if defaultTimeVariables:
+        if thread.defaultTimeVariables:
             self.window.time.loadTimeVariables(self.window.stat)
-        # If old data - skip loading default variables and directly load time widgets
+        # If the same data were preprocessed again - keep time variables,
+        # only fit them to the new length
+        elif thread.fitTimeVariables:
+            self.window.time.extendTimeVariables(self.window.stat)
+        # If time variables were restored from params file - keep them as they are
         else:
             self.window.time.loadTimeWidgets()
 
@@ -130,8 +254,11 @@ class File:
             self.window.time.timeParams['endSelected'])
 
         # Get statistics and fill the table
+        self.updateProgress('Statistics', 90)
         self.window.table.fillTable()
 
+        self.finishLoading()
+
         # After raw data were loaded, allow saving output data
         self.fileItems.loc['saveData', 'action'].setEnabled(True)
         # self.fileItems.loc['saveMap', 'action'].setEnabled(True) #TODO
@@ -139,9 +266,237 @@ class File:
 
         # Reuse file name later to suggest name for output statistics file,
         # and to reload this data if they fit a new params file
+        self.loadDataFiles = thread.loadDataFiles
+        self.loadDataFile = self.loadDataFiles[0]
+        self.updateDataFileNameLabel(self.loadDataFile)
+
+        # Report memory used by this recording
+        self.fileNameLabel.setToolTip(
+            '\n'.join(self.loadDataFiles) + '\n'
+            + f'Preprocessed data: {self.window.stat.memory_usage() / 1024**2:.1f} MB')
+
+    def loadFailed(self, thread, error):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        if thread is not self.loadThread:
+            return
+
+        self.finishLoading()
+        QMessageBox.warning(self.window, 'Unreadable raw data', error)
+        self.hasDataFile = False
+
+    def loadStopped(self, thread):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        # Thread finished. Loaded data and errors were already handled and
+        # a cancelled thread was detached, so this only closes the dialog
+        # of a thread that stopped without sending anything
+        if thread is self.loadThread:
+            self.finishLoading()
+
+    def updateProgress(self, stage, percent):
+        if self.progressDialog is None:
+            return
+
+        self.progressDialog.setLabelText(stage)
+        if percent >= 0:
+            self.progressDialog.setValue(percent)
+
+    def finishLoading(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Close progress dialog, previously loaded data are kept '''
+
+        self.loadThread = None
+
+        if self.progressDialog is not None:
+            self.progressDialog.canceled.disconnect()
+            self.progressDialog.reset()
+            self.progressDialog.hide()
+            self.progressDialog.deleteLater()
+            self.progressDialog = None
+
+    def cancelLoading(self, wait=False):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Stop reading at the next stage or chunk. Previous data stay loaded.
+        Wait for the thread to stop, e.g. before the app is closed
+        '''
+
+        if self.loadThread is None:
+            return
+
+        thread = self.loadThread
+        thread.cancel()
+        self.finishLoading()
+
+        if wait:
+            thread.wait()
+
+    def orderParts(self, loadDataFiles):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Parts of a recording in order of their numbers, e.g. _2 before _10 '''
+
+        return sorted(loadDataFiles,
+                      key=lambda path: [int(part) if part.isdigit() else part
+                                        for part in re.split(r'(\d+)', path)])
+
+    def readRecording(self, loadDataFiles, progress):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Read and preprocess parts of a recording and join them.
+        Each part is read and cached separately, so that adding a part
+        to the recording only reads the new one
+        '''
+
+        parts = []
+        for i, loadDataFile in enumerate(loadDataFiles):
+            # Progress through all parts
+            def partProgress(stage, fraction=None):
+                if len(loadDataFiles) > 1:
+                    stage = f'{stage} (part {i + 1} of {len(loadDataFiles)})'
+                if fraction is not None:
+                    fraction = (i + fraction) / len(loadDataFiles)
+                progress(stage, fraction)
+
+            try:
+                df, (maxX, maxY) = self.readData(loadDataFile, partProgress)
+            # Tell which part could not be parsed
+            except ValueError as error:
+                raise ValueError(f'{loadDataFile}\n\n{error}') from error
+
+            if maxX or maxY:
+                return None, (maxX, maxY)
+            parts.append(df)
+
+        df = self.window.stat.join_parts(parts)
+        # Parts are cached as runs, a run can continue in the next part
+        if self.params['trajectoryRLE'] and len(parts) > 1:
+            df = self.window.stat.to_runs(df)
+
+        return df, (0, 0)
+
+    def readData(self, loadDataFile, progress):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Read and preprocess raw data file of any supported format.
+        Return preprocessed data (None if they do not fit field settings)
+        and max X and Y if data do not fit field settings, zeros otherwise.
+        Runs in LoadThread, progress(stage, fraction) is called between stages
+        '''
+
+        progress('Parsing', 0)
+
+        # Preprocessed data of this file with these field settings are cached.
+        # They were checked to fit field settings before caching
+        cachedData = self.cache.load(loadDataFile)
+        if cachedData is not None:
+            return cachedData, (0, 0)
+
+        # Large files are read and preprocessed chunk by chunk,
+        # data are checked to fit field settings for each chunk
+        if self.reader.is_large(loadDataFile):
+            df, (maxX, maxY) = self.window.stat.process_raw_data_chunked(
+                self.reader.read_raw_data_chunks(loadDataFile),
+                lambda stage, fraction=None: progress(
+                    stage, self.reader.read_fraction))
+        else:
+            raw_df = self.reader.read_raw_data(loadDataFile)
+            # Check if data correspond to field settings
+            df = None
+            maxX, maxY = self.window.stat.checkDataToField(raw_df)
+            if not (maxX or maxY):
+                df = self.window.stat.process_raw_data(raw_df, progress)
+                # Chunked preprocessing makes runs chunk by chunk
+                if self.params['trajectoryRLE']:
+                    df = self.window.stat.to_runs(df)
+
+        if df is not None:
+            progress('Saving to cache')
+            self.cache.save(loadDataFile, df)
+
+        return df, (maxX, maxY)
+
+    def followData(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Follow raw data file while acquisition software is writing it '''
+
+        # Action was unchecked, stop following
+        if self.liveTimer.isActive():
+            self.stopFollowing()
+            return
+
+        loadDataFile, _filter = QFileDialog.getOpenFileName(
+            parent=self.window,
+            caption=self.fileItems.loc['followData', 'caption'],
+            directory=self.params['dirs']['loadData'],
+            filter=self.textDataFilters
+            )
+        # FileDialog was exited with cancel
+        if not loadDataFile:
+            self.fileItems.loc['followData', 'action'].setChecked(False)
+            return
+
+        # There are no data until the first complete rows are read
+        self.hasDataFile = False
+        self.tail = self.reader.tail(loadDataFile)
+        self.window.stat.start_live()
+
         self.loadDataFile = loadDataFile
+        self.loadDataFiles = [loadDataFile]
         self.updateDataFileNameLabel(self.loadDataFile)
 
+        self.updateLiveData()
+        self.liveTimer.start(LIVE_INTERVAL)
+
+    def updateLiveData(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Preprocess rows written since the last update, update map and table '''
+
+        raw_df = self.tail.read()
+        if raw_df is None:
+            return
+
+        # Check if data correspond to field settings
+        maxX, maxY = self.window.stat.checkDataToField(raw_df)
+        if maxX or maxY:
+            self.stopFollowing()
+            self.incorrectData(maxX, maxY)
+            self.hasDataFile = False
+            return
+
+        # New rows did not complete any sample yet
+        if not self.window.stat.append_raw_data(raw_df):
+            return
+
+        # First data of the recording
+        if not self.hasDataFile:
+            self.hasDataFile = True
+            self.window.time.loadTimeVariables(self.window.stat)
+
+            self.fileItems.loc['saveData', 'action'].setEnabled(True)
+            self.saveDataButton.setEnabled(True)
+        else:
+            self.window.time.extendTimeVariables(self.window.stat)
+
+        self.window.map.updateMapPath(
+            self.window.time.timeParams['startSelected'],
+            self.window.time.timeParams['endSelected'])
+
+        self.window.table.fillTable()
+
+    def stopFollowing(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        self.liveTimer.stop()
+        self.fileItems.loc['followData', 'action'].setChecked(False)
+
     def incorrectData(self, maxX, maxY):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
@@ -175,11 +530,50 @@ class File:
 
         ''' If numLasers parameter was changed - reset zoneCoord '''
 
+        self.stopFollowing()
+        self.cancelLoading()
         self.updateDataFileNameLabel('')
+        self.fileNameLabel.setToolTip('')
 
         self.window.map.deleteMapButtons()
         self.window.time.deleteTime()
 
+    def loadEvents(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Load event file with timestamps and labels. Statistics around
+        the events are saved with statistics of each recording
+        '''
+
+        loadEventsFile, _filter = QFileDialog.getOpenFileName(
+            parent=self.window,
+            caption=self.fileItems.loc['loadEvents', 'caption'],
+            directory=self.params['dirs']['loadData'],
+            filter=self.eventFilters
+            )
+
+        # FileDialog was exited with cancel
+        if not loadEventsFile:
+            return
+
+        try:
+            events = self.reader.read_events(loadEventsFile)
+        except (OSError, UnicodeDecodeError, ValueError) as error:
+            QMessageBox.warning(self.window, 'Unreadable events', str(error))
+            return
+
+        # Recordings are averaged only with the same events
+        self.window.stat.events = events
+        self.window.stat.event_results.clear()
+
+        labels = events['label'].nunique()
+        QMessageBox.information(
+            self.window, self.fileItems.loc['loadEvents', 'caption'],
+            f'{len(events)} events of {labels} types were loaded.\n'
+            + 'Statistics around them are saved with the statistics '
+            + 'of each recording.')
+
     def loadParams(self):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
@@ -213,8 +607,15 @@ class File:
         # according to the new settings
         self.deleteData()
 
-        # Update zoneCoord, implement zone map from new parameters
-        self.window.map.zoneCoord[:, :] = params['zoneCoord']
+        # Update zoneCoord, implement zone map from new parameters.
+        # Parameters saved before zones could overlap hold zone numbers,
+        # possibly with gaps. They are numbered 1, 2, ... again
+        zoneCoord = np.array(params['zoneCoord'])
+        if not params.get('zoneMasks'):
+            zones = np.unique(zoneCoord[zoneCoord > 0])
+            zoneCoord = np.where(zoneCoord > 0,
+                                 1 << np.searchsorted(zones, zoneCoord), 0)
+        self.window.map.zoneCoord[:, :] = zoneCoord
         self.window.map.loadMap()
 
         # Update time parameters and load back existing data (if appropriate)
@@ -226,7 +627,7 @@ class File:
                 self.window.time.timeParams.update(params['timeParams'])
                 defaultTimeVariables = False
 
-            self.loadData(self.loadDataFile, defaultTimeVariables)
+            self.loadData(self.loadDataFiles, defaultTimeVariables)
             return  # fillTable will be called from loadData() in this case
 
         # Fill table with empty dataframe
@@ -246,17 +647,31 @@ class File:
             parent=self.window,
             caption=self.fileItems.loc['saveData', 'caption'],
             directory=path,
-            filter=self.dataFilters
+            filter=self.outputFilters
             )
 
         # FileDialog was exited with cancel
         if not saveDataFile:
             return
 
+        try:
+            tables = self.window.table.getSavedData(self.loadDataFile)
+        except Exception as error:
+            traceback.print_exc()
+            QMessageBox.warning(self.window, 'Statistics not saved',
+                                str(error) or type(error).__name__)
+            return
+
         with open(saveDataFile, 'w+', newline='') as file:
-            self.window.stat.data.to_csv(file,
-                                         sep=self.params['separator'],
-                                         decimal=self.params['decimal'])
+            # Statistics around loaded events follow the main table
+            for title, data in tables:
+                if title:
+                    file.write(f'\n{title}\n')
+                if data is None:
+                    continue
+                data.to_csv(file,
+                            sep=self.params['separator'],
+                            decimal=self.params['decimal'])
 
     def saveParams(self, saveParamsFile=None):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
@@ -277,6 +692,7 @@ class File:
         params = {}
         params['settings'] = copy.deepcopy(self.params)
         params['zoneCoord'] = self.window.map.zoneCoord.tolist()
+        params['zoneMasks'] = True  # zoneCoord holds bitmasks of zones
         params['timeParams'] = self.window.time.timeParams.copy()
 
         with open(saveParamsFile, 'w+', newline='') as file:
@@ -0,0 +1,95 @@
+import os
+import numpy as np
+
+# Optional compiled backend of the loops over samples
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+BACKENDS = ['auto', 'numpy', 'numba']
+# Environment variable selecting the backend, overrides the setting
+BACKEND_VARIABLE = 'OPEN_FIELD_BACKEND'
+
+
+def select_backend(setting):
+    '''
+    Backend of the loops over samples: 'numba' or 'numpy'.
+    Numba is used if it is installed, unless NumPy is chosen
+    '''
+
+    backend = os.environ.get(BACKEND_VARIABLE, setting).lower()
+    if backend not in BACKENDS:
+        print(f'Unknown backend {backend}, using auto')
+        backend = 'auto'
+
+    if backend == 'numpy' or numba is None:
+        if backend == 'numba':
+            print('Numba is not installed, using NumPy')
+        return 'numpy'
+
+    return 'numba'
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _filter_ambulatory(beams, last_value, last_diff, last_amb):
+        n, axes = beams.shape
+        amb = np.empty_like(beams)
+        last_value = last_value.copy()
+        last_diff = last_diff.copy()
+        last_amb = last_amb.copy()
+
+        for axis in range(axes):
+            for row in range(n):
+                diff = beams[row, axis] - last_value[axis]
+                # First NaN is a change too
+                if diff != 0:
+                    # Not accepted if it reverses the previous change
+                    if not diff + last_diff[axis] == 0:
+                        last_amb[axis] = beams[row, axis]
+                    last_diff[axis] = diff
+                last_value[axis] = beams[row, axis]
+                amb[row, axis] = last_amb[axis]
+
+        return amb, last_value, last_diff, last_amb
+
+    @numba.njit(cache=True)
+    def _sum_periods(values, zone_index, edges, num_zones):
+        periods = len(edges) - 1
+        sums = np.zeros((periods + 1, values.shape[1], num_zones))
+
+        period = 0
+        for row in range(len(values)):
+            # Rows outside of the selected time go after the last period
+            if row < edges[0] or row >= edges[-1]:
+                key = periods
+            else:
+                while row >= edges[period + 1]:
+                    period += 1
+                key = period
+            for stat in range(values.shape[1]):
+                sums[key, stat, zone_index[row]] += values[row, stat]
+
+        return sums
+
+
+def filter_ambulatory(beams, state=None):
+    ''' Compiled data_processing.filter_ambulatory, one pass per axis '''
+
+    if state is None:
+        state = (np.full(beams.shape[1], np.nan),) * 3
+
+    amb, *state = _filter_ambulatory(np.ascontiguousarray(beams), *state)
+
+    return amb, tuple(state)
+
+
+def sum_periods(values, zone_index, edges, num_zones):
+    '''
+    Compiled sums of values (rows, stats) by period and zone of rows,
+    (periods + outside, stats, zones). Periods start at rows of edges
+    '''
+
+    return _sum_periods(values, zone_index, edges, num_zones)
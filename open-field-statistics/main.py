@@ -1,5 +1,6 @@
 import sys
 import inspect
+import multiprocessing
 
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QStyleFactory,
@@ -110,6 +111,8 @@ class MainWindow(QMainWindow):
     def closeEvent(self, event):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
+        self.file.cancelLoading(wait=True)
+        self.table.stopComputing()
         self.settings.saveRecentSettings()
 
     # def resizeEvent(self, e):
@@ -128,6 +131,9 @@ class MainWindow(QMainWindow):
 
 
 if __name__ == '__main__':
+    # Large files are parsed on a process pool, also in a frozen executable
+    multiprocessing.freeze_support()
+
     app = QApplication(sys.argv)
     app.setStyle(QStyleFactory.create('Fusion'))
     window = MainWindow(app)
@@ -1,7 +1,10 @@
 import inspect
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-from PyQt6.QtWidgets import QTableView, QHeaderView, QAbstractItemView
-from PyQt6.QtCore import Qt, QAbstractTableModel
+from PyQt6.QtWidgets import (QTableView, QHeaderView, QAbstractItemView,
+                             QMessageBox)
+from PyQt6.QtCore import Qt, QAbstractTableModel, pyqtSignal
 from PyQt6.QtGui import QColor
 
 from color_style import ColorStyle
@@ -19,7 +22,8 @@ class TableModel(QAbstractTableModel):
 
     def data(self, index, role):
 
-        numStatParam = len(self.window.settings.params['statParams'])
+        # Transitions matrix takes several rows
+        numStatParam = self._data.index.levshape[1]
 
         if role == Qt.ItemDataRole.DisplayRole:
             value = self._data.iloc[index.row(), index.column()]
@@ -69,6 +73,11 @@ class TableModel(QAbstractTableModel):
 
 
 class TableView(QTableView):
+    # Statistics computed in background: request number, data
+    dataComputed = pyqtSignal(int, object)
+    # Statistics could not be computed: request number, error message
+    computeFailed = pyqtSignal(int, str)
+
     def __init__(self, window, app):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
@@ -77,6 +86,15 @@ class TableView(QTableView):
         self.window = window
         self.app = app
 
+        # Statistics are computed one request at a time. Requests made
+        # meanwhile replace each other, only the latest one is computed next
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.request = 0  # Number of the latest request
+        self.computing = False
+        self.pendingSnapshot = None
+        self.dataComputed.connect(self.showComputedData)
+        self.computeFailed.connect(self.showComputeError)
+
         data = self.window.stat.dummy_data
         data = self.renameStatisticsHeaders(data)
         self.model = TableModel(data, window)
@@ -127,22 +145,123 @@ class TableView(QTableView):
     def renameStatisticsHeaders(self, data):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
-        return (data
-                .rename(index={'time': 'Time (s)',
-                               'dist_total': 'Distance-total (cm)',
-                               'dist_amb': 'Distance-ambulatory (cm)',
-                               'velocity': 'Velocity (cm/s)',
-                               'rearing_n': 'Rearings number',
-                               'rearing_time': 'Rearings time (s)'},
-                        )
-                )
+        headers = {'time': 'Time (s)',
+                   'dist_total': 'Distance-total (cm)',
+                   'dist_amb': 'Distance-ambulatory (cm)',
+                   'velocity': 'Velocity (cm/s)',
+                   'rearing_n': 'Rearings number',
+                   'rearing_time': 'Rearings time (s)',
+                   'rearing_duration': 'Rearing bout mean duration (s)',
+                   'rearing_latency': 'Rearing latency (s)',
+                   'immobility_n': 'Immobility bouts number',
+                   'immobility_time': 'Immobility time (s)',
+                   'immobility_duration': 'Immobility bout mean duration (s)',
+                   'immobility_latency': 'Immobility latency (s)',
+                   'entries': 'Zone entries',
+                   'exits': 'Zone exits',
+                   'visit_duration': 'Mean visit duration (s)'}
+        # One row of transitions matrix for each zone
+        headers.update({
+            stat: f"Transitions to zone {stat.removeprefix('transitions_to_')}"
+            for stat in data.index.get_level_values(1)
+            if stat.startswith('transitions_to_')})
+
+        return data.rename(index=headers)
 
     def fillTable(self):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
-        ''' Fill table with statistics '''
+        ''' Fill table with statistics, computed in background '''
+
+        self.request += 1
+        snapshot = self.window.stat.snapshot()
+
+        # Without loaded file show an empty table right away
+        if snapshot['df'] is None:
+            self.pendingSnapshot = None
+            self.showData(self.window.stat.get_data(snapshot))
+            return
+
+        # Replaces older request that did not start yet
+        self.pendingSnapshot = (self.request, snapshot)
+        if not self.computing:
+            self.computeNext()
+
+    def computeNext(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        request, snapshot = self.pendingSnapshot
+        self.pendingSnapshot = None
+        self.computing = True
+        self.executor.submit(self.computeData, request, snapshot)
+
+    def computeData(self, request, snapshot):
+        ''' Runs in background thread '''
+
+        try:
+            data = self.window.stat.get_data(snapshot)
+        except Exception as error:
+            traceback.print_exc()
+            self.computeFailed.emit(request, str(error) or type(error).__name__)
+            return
+        self.dataComputed.emit(request, data)
+
+    def showComputedData(self, request, data):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        self.computing = False
+        # Result is already stale, compute the latest request instead
+        if self.pendingSnapshot is not None:
+            self.computeNext()
+        if request == self.request:
+            self.showData(data)
+
+    def showComputeError(self, request, error):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        self.computing = False
+        if self.pendingSnapshot is not None:
+            self.computeNext()
+        if request != self.request:
+            return
+
+        # Do not leave statistics of the previous request in the table
+        self.showData(self.window.stat.make_dummy_data())
+        QMessageBox.warning(self.window, 'Statistics not computed', error)
+
+    def getSavedData(self, recording):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Statistics of the current zones and time, and peri-event statistics
+        of the same snapshot, [(title, table)]. Computed in background after
+        the request being computed, so that the table of another file or
+        configuration is not saved
+        '''
+
+        snapshot = self.window.stat.snapshot()
+        future = self.executor.submit(self.computeSavedData, snapshot, recording)
+
+        return future.result()
+
+    def computeSavedData(self, snapshot, recording):
+        ''' Runs in background thread '''
+
+        return ([(None, self.window.stat.get_data(snapshot))]
+                + self.window.stat.get_event_data(snapshot, recording))
+
+    def stopComputing(self):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        self.pendingSnapshot = None
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def showData(self, data):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        # Shown statistics are saved by 'Save statistics'
+        self.window.stat.data = data
 
-        data = self.window.stat.get_data()
         data = self.renameStatisticsHeaders(data)
         self.model.updateData(data)
 
@@ -12,11 +12,29 @@ from PyQt6.QtWidgets import (
 )
 from PyQt6.QtGui import QKeySequence
 
+from kernels import BACKENDS, BACKEND_VARIABLE
+
 
 DEFAULT_FOLDER_TYPES = ['loadData', 'params', 'saveData', 'saveMap']
 FIELD_PARAMETERS = ['numLasersX', 'numLasersY', 'boxSideX', 'boxSideY']
+# Settings each processing stage depends on. A change re-runs only its
+# stages, later stages are cached by their own inputs (zones, time).
+# Parsing, beam cleanup, resampling, ambulatory filter and runs are made
+# in one pass over raw data, cached on disk
+STAGE_PARAMETERS = {
+    'field': ['numLasersX', 'numLasersY'],  # Zone map and cells of samples
+    'preprocessing': ['numLasersX', 'numLasersY', 'sampleInterval'],
+    'runs': ['trajectoryRLE'],
+    'scaling': ['boxSideX', 'boxSideY'],  # Distances in cm, map proportions
+    'bouts': ['immobilityTime'],
+    'formatting': ['statParams'],
+    }
 ALL_STAT_PARAMS = ['time', 'dist_total', 'dist_amb', 'velocity',
-                   'rearing_n', 'rearing_time']
+                   'rearing_n', 'rearing_time',
+                   'rearing_duration', 'rearing_latency',
+                   'immobility_n', 'immobility_time',
+                   'immobility_duration', 'immobility_latency',
+                   'entries', 'exits', 'visit_duration', 'transitions']
 DEFAULT_SETTINGS = {
     # File parameters:
     'dirs': {folder: None for folder in DEFAULT_FOLDER_TYPES},
@@ -28,7 +46,15 @@ DEFAULT_SETTINGS = {
     'boxSideY': 40.,
 
     # Statistics parameters
-    'statParams': ALL_STAT_PARAMS,
+    'statParams': ALL_STAT_PARAMS[:-1],  # Transitions are many rows
+    'immobilityTime': 2.,  # Shortest immobility bout, s
+    'eventWindowBefore': 60.,  # Peri-event windows, s
+    'eventWindowAfter': 60.,
+
+    # Processing parameters:
+    'trajectoryRLE': False,  # Keep runs of identical samples as one row
+    'sampleInterval': 100,   # Resampling interval, ms. 0 keeps native rate
+    'kernelBackend': 'auto',  # Loops over samples: 'auto', 'numpy', 'numba'
 
     # Output parameters:
     'separator': ';',
@@ -53,6 +79,9 @@ class Settings():
             path = os.path.join('temp', 'recent_settings.json')
             with open(path, 'r', newline='') as file:
                 recentSettings = json.load(file)
+            # Settings added since the file was saved
+            recentSettings = {**copy.deepcopy(DEFAULT_SETTINGS),
+                              **recentSettings}
         else:
             recentSettings = DEFAULT_SETTINGS
 
@@ -65,14 +94,44 @@ class Settings():
         newSettings = self.settingsDialog.show()
         if newSettings:
             newSettings['statParams'].sort(key = lambda i: ALL_STAT_PARAMS.index(i))
+            changed = [param for param, value in newSettings.items()
+                       if value != self.params[param]]
             self.params.update(newSettings)
-            if self.settingsDialog.fieldParameterChanged:
-                self.window.file.deleteData()
-                self.window.file.hasDataFile = False
-                self.window.map.loadMap()
-            self.window.table.fillTable()
+            self.applySettings(changed)
             self.saveRecentSettings()
 
+    def applySettings(self, changed):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        ''' Re-run only processing stages that depend on changed settings '''
+
+        def stageChanged(*stages):
+            return any(param in changed
+                       for stage in stages
+                       for param in STAGE_PARAMETERS[stage])
+
+        # Zone map of another size, data do not fit it
+        if stageChanged('field'):
+            self.window.file.deleteData()
+            self.window.file.hasDataFile = False
+            self.window.map.loadMap()
+            self.window.table.fillTable()
+            return
+
+        if stageChanged('scaling'):
+            self.window.map.resizeMap()
+
+        # Preprocess the same files again, keeping zones and time.
+        # Table is filled when they are loaded
+        if self.window.file.hasDataFile and stageChanged('preprocessing', 'runs'):
+            self.window.file.loadData(self.window.file.loadDataFiles,
+                                      defaultTimeVariables=False,
+                                      fitTimeVariables=True)
+        # Aggregated statistics are cached, only scaled and re-indexed.
+        # Bouts are found again for another immobility time
+        elif stageChanged('scaling', 'bouts', 'formatting'):
+            self.window.table.fillTable()
+
     def saveRecentSettings(self):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
@@ -89,8 +148,6 @@ class Settings():
 
             self.tempSettings = copy.deepcopy(settings)
 
-            self.fieldParameterChanged = False
-
             self.setWindowTitle('Settings')
 
             dialogButtons = QDialogButtonBox.StandardButton.Save | QDialogButtonBox.StandardButton.Cancel
@@ -102,6 +159,7 @@ class Settings():
             self.layout.addWidget(self.createFileGroup())
             self.layout.addWidget(self.createFieldParametersGroup())
             self.layout.addWidget(self.createStatisticsGroup())
+            self.layout.addWidget(self.createProcessingGroup())
             self.layout.addWidget(self.createOutputFormatGroup())
 
             self.layout.addWidget(self.buttonBox)
@@ -111,8 +169,6 @@ class Settings():
 
             if self.exec():
                 return copy.deepcopy(self.tempSettings)
-            else:
-                self.fieldParameterChanged = False
 
         def createFileGroup(self):
             print(__class__.__name__, inspect.currentframe().f_code.co_name)
@@ -236,7 +292,6 @@ class Settings():
             print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
             self.tempSettings.update({parameter: value})
-            self.fieldParameterChanged = True
 
         def createStatisticsGroup(self):
             print(__class__.__name__, inspect.currentframe().f_code.co_name)
@@ -254,7 +309,17 @@ class Settings():
                 'Distance-ambulatory',
                 'Velocity',
                 'Rearings number',
-                'Rearings time'
+                'Rearings time',
+                'Rearing bout mean duration',
+                'Rearing latency',
+                'Immobility bouts number',
+                'Immobility time',
+                'Immobility bout mean duration',
+                'Immobility latency',
+                'Zone entries',
+                'Zone exits',
+                'Mean visit duration',
+                'Transitions between zones'
                 ]
 
             for stat in stats:
@@ -270,8 +335,91 @@ class Settings():
 
                 statisticsGroupLayout.addWidget(statItems.loc[stat, 'checkBox'])
 
+            immobilityTimeLabel = QLabel('Shortest immobility bout')
+            immobilityTime = QDoubleSpinBox()
+            immobilityTime.setRange(0.1, 999.)
+            immobilityTime.setDecimals(1)
+            immobilityTime.setSuffix(' s')
+            immobilityTime.setToolTip(
+                'Time without ambulatory movement counted as immobility.')
+            immobilityTime.setValue(self.tempSettings['immobilityTime'])
+
+            immobilityTime.valueChanged.connect(lambda val:
+                self.tempSettings.update({'immobilityTime': val}))
+
+            statisticsGroupLayout.addWidget(immobilityTimeLabel)
+            statisticsGroupLayout.addWidget(immobilityTime)
+
+            # Peri-event windows are used only when statistics are saved
+            for window, caption in [('eventWindowBefore', 'Window before events'),
+                                    ('eventWindowAfter', 'Window after events')]:
+                eventWindowLabel = QLabel(caption)
+                eventWindow = QDoubleSpinBox()
+                eventWindow.setRange(0.1, 99999.)
+                eventWindow.setDecimals(1)
+                eventWindow.setSuffix(' s')
+                eventWindow.setToolTip(
+                    'Statistics around each event of the loaded event file.')
+                eventWindow.setValue(self.tempSettings[window])
+
+                eventWindow.valueChanged.connect(lambda val, window_=window:
+                    self.tempSettings.update({window_: val}))
+
+                statisticsGroupLayout.addWidget(eventWindowLabel)
+                statisticsGroupLayout.addWidget(eventWindow)
+
             return statisticsGroup
 
+        def createProcessingGroup(self):
+            print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+            processingGroup = QGroupBox('Processing')
+            processingGroupLayout = QGridLayout(processingGroup)
+
+            trajectoryRLE = QCheckBox('Compact immobile stretches of trajectory')
+            trajectoryRLE.setToolTip(
+                'Keep consecutive identical samples as one run.\n'
+                + 'Saves memory and time on recordings with long immobility.')
+            trajectoryRLE.setChecked(self.tempSettings['trajectoryRLE'])
+
+            trajectoryRLE.toggled.connect(lambda checked:
+                self.tempSettings.update({'trajectoryRLE': checked}))
+
+            sampleIntervalLabel = QLabel('Sample interval')
+            sampleInterval = QSpinBox()
+            sampleInterval.setRange(0, 1000)
+            sampleInterval.setSingleStep(50)
+            sampleInterval.setSuffix(' ms')
+            # Samples are weighted by time to the next timestamp instead
+            sampleInterval.setSpecialValueText('Native rate')
+            sampleInterval.setToolTip(
+                'Interval the raw data are resampled to.\n'
+                + 'Native rate keeps every timestamp of the raw data.')
+            sampleInterval.setValue(self.tempSettings['sampleInterval'])
+
+            sampleInterval.valueChanged.connect(lambda val:
+                self.tempSettings.update({'sampleInterval': val}))
+
+            kernelBackendLabel = QLabel('Computation backend')
+            kernelBackend = QComboBox()
+            kernelBackend.addItems(['Automatic', 'NumPy', 'Numba'])
+            kernelBackend.setToolTip(
+                'Numba compiles loops over samples, if it is installed.\n'
+                + f'Environment variable {BACKEND_VARIABLE} overrides this.')
+            kernelBackend.setCurrentIndex(
+                BACKENDS.index(self.tempSettings['kernelBackend']))
+
+            kernelBackend.currentIndexChanged.connect(lambda index:
+                self.tempSettings.update({'kernelBackend': BACKENDS[index]}))
+
+            processingGroupLayout.addWidget(trajectoryRLE, 0, 0, 1, 2)
+            processingGroupLayout.addWidget(sampleIntervalLabel, 1, 0)
+            processingGroupLayout.addWidget(sampleInterval, 1, 1)
+            processingGroupLayout.addWidget(kernelBackendLabel, 2, 0)
+            processingGroupLayout.addWidget(kernelBackend, 2, 1)
+
+            return processingGroup
+
         #??? Just trust some locale?
         def createOutputFormatGroup(self):
             print(__class__.__name__, inspect.currentframe().f_code.co_name)
@@ -5,12 +5,15 @@ from PyQt6.QtWidgets import (
     QDoubleSpinBox, QAbstractSpinBox, QLabel, QToolTip,
     QGroupBox, QHBoxLayout, QGridLayout,
 )
-from PyQt6.QtCore import Qt, QVariantAnimation, QSignalBlocker
+from PyQt6.QtCore import Qt, QVariantAnimation, QSignalBlocker, QTimer
 from PyQt6.QtGui import QColor, QPalette
 
 from superqt import QRangeSlider
 
 
+MAP_UPDATE_INTERVAL = 50  # Map is redrawn at most this often while slider is moved, ms
+
+
 class TimeParameters:
 
     def __init__(self, window):
@@ -77,6 +80,14 @@ class TimeParameters:
         self.timeRangeSlider.sliderMoved.connect(self.sliderUpdateSelectedTime)
         self.timeRangeSlider.sliderReleased.connect(self.updateSelectedTime)
 
+        # Path or heatmap of the last slider position is drawn after
+        # a short delay, not on every move
+        self.mapUpdateTimer = QTimer()
+        self.mapUpdateTimer.setSingleShot(True)
+        self.mapUpdateTimer.setInterval(MAP_UPDATE_INTERVAL)
+        self.mapUpdateTimer.timeout.connect(
+            lambda: self.window.map.updateMapPath(*self.sliderRange))
+
     def setTimeLayouts(self):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
@@ -112,7 +123,7 @@ class TimeParameters:
 
         ''' Update time variables based on loaded raw data '''
 
-        self.totalTime = stat.df.index[-1].total_seconds()
+        self.totalTime = stat.total_time()
 
         self.timeParams['startSelected'] = 0
         self.timeParams['endSelected'] = self.totalTime
@@ -123,6 +134,27 @@ class TimeParameters:
 
         self.loadTimeWidgets()
 
+    def extendTimeVariables(self, stat):
+        print(__class__.__name__, inspect.currentframe().f_code.co_name)
+
+        '''
+        Update time variables when raw data of live recording grow,
+        or the same data were preprocessed again
+        '''
+
+        oldTotalTime = self.totalTime
+        self.totalTime = stat.total_time()
+
+        # Selected time and single period follow the end of the recording,
+        # unless user has changed them
+        if self.timeParams['endSelected'] >= oldTotalTime:
+            self.timeParams['endSelected'] = self.totalTime
+            if abs(self.timeParams['period'] - self.selectedTime) < 0.05:
+                self.timeParams['period'] = round(
+                    self.totalTime - self.timeParams['startSelected'], 1)
+
+        self.loadTimeWidgets()
+
     def loadTimeWidgets(self):
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
@@ -153,6 +185,8 @@ class TimeParameters:
         print(__class__.__name__, inspect.currentframe().f_code.co_name)
 
         self.timeParams.update({key: 0 for key in self.timeParams})
+        # Path of deleted data is not drawn
+        self.mapUpdateTimer.stop()
 
         self.startSelectedLine.setValue(self.timeParams['startSelected'])
         self.endSelectedLine.setValue(self.timeParams['endSelected'])
@@ -260,7 +294,9 @@ class TimeParameters:
         with QSignalBlocker(self.endSelectedLine):
             self.endSelectedLine.setValue(end)
 
-        self.window.map.updateMapPath(start, end)
+        self.sliderRange = (start, end)
+        if not self.mapUpdateTimer.isActive():
+            self.mapUpdateTimer.start()
         # Do not update SelectedTime values here while slider is being moved
 
     def updateSelectedTime(self, start=None, end=None):